@@ -0,0 +1,182 @@
+'''
+Columnar table of geocoded accidents.
+
+Instead of one dict per accident the table holds typed NumPy columns:
+year, count, number of streets and center coordinates (NaN if there is
+no center) per row, directorate and street as codes into label lists,
+and the matched feature indices of all rows in one flat array with
+per-row offsets. Aggregating generators group over these columns and
+row generators only build small dicts for the rows they write.
+'''
+import numpy
+
+
+class AccidentTable(object):
+    # (years, feature ids, counts), built on first use
+    _year_feature_counts = None
+
+    def __init__(self, year, count, street_count, center_x, center_y,
+                 directorate, directorates, street, streets,
+                 feature_offsets, feature_idx):
+        self.year = year
+        self.count = count
+        self.street_count = street_count
+        self.center_x = center_x
+        self.center_y = center_y
+        self.directorate = directorate
+        self.directorates = directorates
+        self.street = street
+        self.streets = streets
+        self.feature_offsets = feature_offsets
+        self.feature_idx = feature_idx
+
+    def __len__(self):
+        return len(self.year)
+
+    @classmethod
+    def from_accidents(cls, accidents):
+        '''
+        Builds a table from geocoded accident dicts as returned by
+        GeoIndex.get_accidents_for_year.
+        '''
+        year, count, street_count, center_x, center_y = [], [], [], [], []
+        directorate, directorates = [], {}
+        street, streets = [], {}
+        feature_offsets, feature_idx = [0], []
+        for accident in accidents:
+            year.append(int(accident['year']))
+            count.append(int(accident['count']))
+            street_count.append(len(accident['streets']))
+            center = accident['center']
+            center_x.append(numpy.nan if center is None else center.x)
+            center_y.append(numpy.nan if center is None else center.y)
+            directorate.append(directorates.setdefault(accident['directorate'], len(directorates)))
+            street.append(streets.setdefault(accident['street'], len(streets)))
+            feature_idx.extend(accident['feature_idx'])
+            feature_offsets.append(len(feature_idx))
+        return cls(
+            numpy.array(year, dtype=numpy.int16),
+            numpy.array(count, dtype=numpy.int32),
+            numpy.array(street_count, dtype=numpy.int16),
+            numpy.array(center_x, dtype=numpy.float64),
+            numpy.array(center_y, dtype=numpy.float64),
+            numpy.array(directorate, dtype=numpy.int32), list(directorates),
+            numpy.array(street, dtype=numpy.int32), list(streets),
+            numpy.array(feature_offsets, dtype=numpy.int64),
+            numpy.array(feature_idx, dtype=numpy.int32)
+        )
+
+    @classmethod
+    def concatenate(cls, tables):
+        '''
+        Appends tables in order, merging their label lists.
+        '''
+        tables = list(tables)
+        if not tables:
+            return cls.from_accidents([])
+        directorates, streets = {}, {}
+        directorate, street, feature_offsets = [], [], []
+        offset = 0
+        for table in tables:
+            codes = numpy.array([directorates.setdefault(d, len(directorates))
+                                 for d in table.directorates], dtype=numpy.int32)
+            directorate.append(codes[table.directorate])
+            codes = numpy.array([streets.setdefault(s, len(streets))
+                                 for s in table.streets], dtype=numpy.int32)
+            street.append(codes[table.street])
+            feature_offsets.append(table.feature_offsets[:-1] + offset)
+            offset += len(table.feature_idx)
+        feature_offsets.append(numpy.array([offset], dtype=numpy.int64))
+        return cls(
+            numpy.concatenate([t.year for t in tables]),
+            numpy.concatenate([t.count for t in tables]),
+            numpy.concatenate([t.street_count for t in tables]),
+            numpy.concatenate([t.center_x for t in tables]),
+            numpy.concatenate([t.center_y for t in tables]),
+            numpy.concatenate(directorate), list(directorates),
+            numpy.concatenate(street), list(streets),
+            numpy.concatenate(feature_offsets),
+            numpy.concatenate([t.feature_idx for t in tables])
+        )
+
+    @property
+    def feature_count(self):
+        return numpy.diff(self.feature_offsets)
+
+    @property
+    def has_center(self):
+        return ~numpy.isnan(self.center_x)
+
+    def select(self, mask):
+        '''
+        Table of the rows where mask is true, sharing the label lists.
+        '''
+        rows = numpy.flatnonzero(mask)
+        feature_count = self.feature_count[rows]
+        feature_offsets = numpy.zeros(len(rows) + 1, dtype=numpy.int64)
+        numpy.cumsum(feature_count, out=feature_offsets[1:])
+        # Position of every selected feature entry in feature_idx
+        positions = (numpy.repeat(self.feature_offsets[rows] - feature_offsets[:-1], feature_count) +
+                     numpy.arange(feature_offsets[-1]))
+        return AccidentTable(
+            self.year[rows], self.count[rows], self.street_count[rows],
+            self.center_x[rows], self.center_y[rows],
+            self.directorate[rows], self.directorates,
+            self.street[rows], self.streets,
+            feature_offsets, self.feature_idx[positions]
+        )
+
+    def get_feature_rows(self):
+        '''
+        Row index of every entry in feature_idx.
+        '''
+        return numpy.repeat(numpy.arange(len(self)), self.feature_count)
+
+    def get_year_feature_counts(self):
+        '''
+        Accident counts per year and matched feature as a dense matrix,
+        returned with the sorted years of its rows and the feature ids
+        of its columns in order of first appearance.
+        '''
+        if self._year_feature_counts is None:
+            feature_rows = self.get_feature_rows()
+            feature_ids, first, inverse = numpy.unique(
+                self.feature_idx, return_index=True, return_inverse=True)
+            order = numpy.argsort(first, kind='stable')
+            columns = numpy.empty(len(order), dtype=numpy.int64)
+            columns[order] = numpy.arange(len(order))
+            years, year_rows = numpy.unique(self.year[feature_rows], return_inverse=True)
+            counts = numpy.zeros((len(years), len(feature_ids)), dtype=numpy.int64)
+            numpy.add.at(counts, (year_rows, columns[inverse]), self.count[feature_rows])
+            self._year_feature_counts = (years, feature_ids[order], counts)
+        return self._year_feature_counts
+
+    def sum_by_feature(self):
+        '''
+        Feature ids in order of first appearance and their total counts.
+        '''
+        _, feature_ids, counts = self.get_year_feature_counts()
+        return feature_ids, counts.sum(axis=0)
+
+    def rows(self):
+        '''
+        Yields one dict per accident with year, count, directorate,
+        street, street_count, feature_idx and center as (x, y) or None.
+        '''
+        offsets = self.feature_offsets.tolist()
+        feature_idx = self.feature_idx.tolist()
+        has_center = self.has_center.tolist()
+        columns = zip(self.year.tolist(), self.count.tolist(),
+                      self.directorate.tolist(), self.street.tolist(),
+                      self.street_count.tolist(), self.center_x.tolist(),
+                      self.center_y.tolist(), has_center)
+        for i, (year, count, directorate, street, street_count, x, y, center) in enumerate(columns):
+            yield {
+                'year': year,
+                'count': count,
+                'directorate': self.directorates[directorate],
+                'street': self.streets[street],
+                'street_count': street_count,
+                'feature_idx': feature_idx[offsets[i]:offsets[i + 1]],
+                'center': (x, y) if center else None
+            }
@@ -0,0 +1,227 @@
+'''
+Benchmark of the parse -> geocode -> export pipeline.
+
+Runs on the committed csvs/*.csv with a synthetic streets GeoJSON and
+the local geometry backend, so neither PostGIS nor network access is
+needed. Prints per-stage timings, throughput and peak memory as JSON:
+
+python -m bench --years 2008,2009 --output bench.json
+'''
+import argparse
+import csv
+import glob
+import io
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+from accident_table import AccidentTable
+from generate import (GENERATORS, GeoIndex, clean_street, get_output_format,
+                      make_name, DISTRICT_HISTORY_FILENAME, MAPPING_FILENAME)
+from geometry import LocalGeometry
+from parser import parse_lines
+from writers import BINARY_FORMATS, OUTPUT_WRITER
+
+
+def get_peak_memory_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def get_years():
+    return sorted(int(os.path.basename(f)[:-4]) for f in glob.glob('csvs/[0-9]*.csv'))
+
+
+def read_rows(years):
+    rows = {}
+    for year in years:
+        with open('csvs/%d.csv' % year) as f:
+            rows[year] = list(csv.DictReader(f))
+    return rows
+
+
+def make_raw_lines(rows):
+    '''
+    Tabula-like raw lines that parse_lines turns back into rows.
+    '''
+    lines = []
+    directorate = None
+    for row in rows:
+        if row['directorate'] != directorate:
+            directorate = row['directorate']
+            lines.append([directorate, '', row['street'], row['count']])
+        else:
+            lines.append(['', '', row['street'], row['count']])
+    return lines
+
+
+def make_districts(directorates):
+    features = []
+    cells = {}
+    for i, directorate in enumerate(sorted(directorates)):
+        x0, y0 = 13.1 + (i % 8) * 0.075, 52.35 + (i // 8) * 0.06
+        cells[directorate] = (x0, y0)
+        features.append({
+            'type': 'Feature',
+            'properties': {'spatial_name': directorate},
+            'geometry': {'type': 'Polygon', 'coordinates': [[
+                [x0, y0], [x0 + 0.075, y0], [x0 + 0.075, y0 + 0.06],
+                [x0, y0 + 0.06], [x0, y0]
+            ]]}
+        })
+    return {'type': 'FeatureCollection', 'features': features}, cells
+
+
+def make_streets(rows, cells, seed=1):
+    '''
+    One random MultiLineString per street name and directorate it
+    appears in (up to three), with a few names left out as lost streets.
+    '''
+    rand = random.Random(seed)
+    names = {}
+    for year_rows in rows.values():
+        for row in year_rows:
+            for street in clean_street(row['street']):
+                names.setdefault(make_name(street), (street, set()))[1].add(row['directorate'])
+    fallback = sorted(cells)[0]
+    features = []
+    for key, (street, directorates) in sorted(names.items()):
+        if rand.random() < 0.03:
+            continue
+        directorates = sorted(d for d in directorates if d in cells) or [fallback]
+        for directorate in directorates[:3]:
+            x0, y0 = cells[directorate]
+            lines = []
+            for _ in range(rand.randint(1, 3)):
+                x, y = x0 + rand.random() * 0.075, y0 + rand.random() * 0.06
+                line = [[x, y]]
+                for _ in range(rand.randint(2, 8)):
+                    x += rand.uniform(-0.002, 0.002)
+                    y += rand.uniform(-0.002, 0.002)
+                    line.append([x, y])
+                lines.append(line)
+            features.append({
+                'type': 'Feature',
+                'properties': {
+                    'name': street, 'osmid': len(features) + 1,
+                    'total_length': 1.0, 'oneway_length': rand.random() * 0.5
+                },
+                'geometry': {'type': 'MultiLineString', 'coordinates': lines}
+            })
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+class Stage(object):
+    def __init__(self, results, name, rows=None):
+        self.results = results
+        self.name = name
+        self.rows = rows
+
+    def __enter__(self):
+        sys.stderr.write('Running %s...\n' % self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        result = {'seconds': seconds, 'peak_memory_kb': get_peak_memory_kb()}
+        if self.rows is not None:
+            result['rows'] = self.rows
+            result['rows_per_second'] = self.rows / seconds if seconds else None
+        if exc is not None:
+            result['error'] = '%s: %s' % (exc_type.__name__, exc)
+        self.results[self.name] = result
+        return exc_type is not None and issubclass(exc_type, Exception)
+
+
+def skip_after_failure(results, name, required):
+    '''
+    Records name as skipped and returns True if a required stage
+    failed or was skipped itself.
+    '''
+    failed = [r for r in required if 'seconds' not in results[r] or 'error' in results[r]]
+    if failed:
+        results[name] = {'skipped': 'requires %s' % ', '.join(failed)}
+    return bool(failed)
+
+
+def run(years, seed=1):
+    stages = {}
+    rows = read_rows(years)
+    row_count = sum(len(r) for r in rows.values())
+
+    raw_lines = {year: make_raw_lines(year_rows) for year, year_rows in rows.items()}
+    with Stage(stages, 'parse_lines', rows=row_count) as stage:
+        stage.rows = sum(len(list(parse_lines(lines))) for lines in raw_lines.values())
+
+    directorates = {row['directorate'] for r in rows.values() for row in r}
+    with open(DISTRICT_HISTORY_FILENAME) as f:
+        district_history = json.load(f)
+    with open(MAPPING_FILENAME) as f:
+        mapping = json.load(f)
+    districts, cells = make_districts(directorates - set(district_history))
+    streets = make_streets(rows, cells, seed=seed)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        streets_filename = os.path.join(tmpdir, 'streets.geojson')
+        districts_filename = os.path.join(tmpdir, 'districts.geojson')
+        with open(streets_filename, 'w') as f:
+            json.dump(streets, f)
+        with open(districts_filename, 'w') as f:
+            json.dump(districts, f)
+
+        with Stage(stages, 'index', rows=len(streets['features'])):
+            idx = GeoIndex(streets_filename, districts_filename,
+                           geometry=LocalGeometry(), mapping=mapping,
+                           district_history=district_history)
+
+    if not skip_after_failure(stages, 'georeference', ['index']):
+        with Stage(stages, 'georeference', rows=row_count):
+            accidents = AccidentTable.from_accidents(idx.get_accidents(years))
+
+    for name in sorted(GENERATORS):
+        if skip_after_failure(stages, 'generate.%s' % name, ['georeference']):
+            continue
+        format = get_output_format(name)
+        with Stage(stages, 'generate.%s' % name) as stage:
+            processed = list(GENERATORS[name][0](idx, accidents))
+            stage.rows = len(processed)
+            fh = io.BytesIO() if format in BINARY_FORMATS else io.StringIO()
+            OUTPUT_WRITER[format](fh, processed, geometries=idx.geometry_cache)
+
+    return {
+        'years': years,
+        'rows': row_count,
+        'features': len(streets['features']),
+        'lost_streets': sum(idx.lost_streets.values()) if 'error' not in stages['index'] else None,
+        'total_seconds': sum(s.get('seconds', 0) for s in stages.values()),
+        'peak_memory_kb': get_peak_memory_kb(),
+        'stages': stages
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the accident pipeline.')
+    parser.add_argument('--years', help='years, defaults to all csvs/*.csv')
+    parser.add_argument('--seed', type=int, default=1, help='seed for synthetic streets')
+    parser.add_argument('--output', help='write JSON results to this file')
+    args = parser.parse_args()
+
+    if args.years:
+        years = [int(y) for y in args.years.split(',')]
+    else:
+        years = get_years()
+    results = run(years, seed=args.seed)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
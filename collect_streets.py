@@ -4,45 +4,82 @@ Reads in OSM export Shapefile (e.g. from http://download.geofabrik.de/),
 clusters by street name and distance and outputs a geojson FeatureCollection
 with MultiLineStrings.
 python cluster_streets.json berlin.roads.shp
+
+Ways are not kept in memory: they are sorted by street name (in order of
+first appearance) in runs of CHUNK_SIZE ways that are spilled to disk,
+and the merged runs are clustered and written one street at a time.
+Coordinates are kept as float arrays.
 (c) Stefan Wehrmeyer, 2015
 License: MIT
 '''
+import heapq
 import math
 import json
-from collections import defaultdict
+import os
+import pickle
+from collections import defaultdict, OrderedDict
+from itertools import groupby, product
 import sys
+import tempfile
 
 import fiona
-from shapely.geometry import shape
+import numpy
+import shapely
 
 
 R = 6371
-DEG_RAD = math.pi / 180
+MAX_DISTANCE_KM = 0.5
+# Ways sorted in memory before they are written to a run file
+CHUNK_SIZE = 100000
+NEIGHBOUR_CELLS = numpy.array(list(product((-1, 0, 1), repeat=3)))
+
+
+def to_unit_vectors(coords):
+    '''
+    Coordinate pairs as points on the unit sphere, with the first
+    coordinate used as latitude as in the original distance function,
+    so that clusters stay the same.
+    '''
+    rad = numpy.radians(numpy.asarray(coords, dtype=float).reshape(-1, 2))
+    cos_lat = numpy.cos(rad[:, 0])
+    return numpy.column_stack((cos_lat * numpy.cos(rad[:, 1]),
+                               cos_lat * numpy.sin(rad[:, 1]),
+                               numpy.sin(rad[:, 0])))
 
 
-def get_distance_in_km(lat1, lng1, lat2, lng2):
-    try:
-        return math.acos(math.sin(lat1 * DEG_RAD) * math.sin(lat2 * DEG_RAD) +
-                         math.cos(lat1 * DEG_RAD) * math.cos(lat2 * DEG_RAD) *
-                         math.cos((lng2 - lng1) * DEG_RAD)) * R
-    except ValueError:
-        return 10000  # arbitrary high value
+def get_chord(km):
+    return 2 * math.sin(km / R / 2)
 
 
-def distance(a, b):
-    return get_distance_in_km(a[0], a[1], b[0], b[1])
+class UnionFind(object):
+    def __init__(self, count):
+        self.parent = list(range(count))
+
+    def find(self, i):
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        # The lower index stays root, so clusters keep their first segment
+        if a > b:
+            a, b = b, a
+        if a != b:
+            self.parent[b] = a
 
 
 class StreetSegment(object):
-    def __init__(self, osmid, name, geometry, **kwargs):
+    def __init__(self, osmid, name, coords, length, **kwargs):
         self.osmid = osmid
         self.name = name
-        self.geometries = [geometry['coordinates']]
+        self.geometries = [coords]
         self.oneway_length = 0
-        self.total_length = shape(geometry).length
+        self.total_length = length
         self.properties = kwargs
         if self.properties['oneway']:
-            self.oneway_length = shape(geometry).length
+            self.oneway_length = length
 
     def __str__(self):
         return u'%s (%s)' % (self.name, len(self.geometry))
@@ -50,22 +87,13 @@ class StreetSegment(object):
     def __repr__(self):
         return self.__str__()
 
-    def try_merge(self, other):
-        if self.distance(other) < 0.5:
-            self.geometries.extend(other.geometries)
-            self.total_length += other.total_length
-            self.oneway_length += other.oneway_length
-            return self
-        return None
-
-    def distance(self, other):
-        mind = float('inf')
-        for geoms in self.geometries:
-            for g in geoms:
-                for ogeoms in other.geometries:
-                    for o in ogeoms:
-                        mind = min(mind, distance(g, o))
-        return mind
+    def merge(self, other):
+        self.geometries.extend(other.geometries)
+        self.total_length += other.total_length
+        self.oneway_length += other.oneway_length
+
+    def vertices(self):
+        return numpy.concatenate([to_unit_vectors(g) for g in self.geometries])
 
     def geojson(self):
         prop = dict(self.properties)
@@ -80,68 +108,184 @@ class StreetSegment(object):
             "properties": prop,
             "geometry": {
                 "type": "MultiLineString",
-                "coordinates": self.geometries
+                "coordinates": [g.tolist() for g in self.geometries]
             }
         }
 
 
-def collect_streets(shp):
-    streets = defaultdict(list)
+def read_ways(shp):
+    '''
+    Yields (name, osmid, oneway, length, coordinates) of named ways,
+    with coordinates as an (n, 2) float array.
+    '''
     i = 0
     for pt in shp:
         name = pt['properties']['name']
-        osmid = pt['properties']['osm_id']
-        if name:
-            seg = StreetSegment(osmid, name, pt['geometry'],
-                        oneway=pt['properties'].get('oneway', 'B') == 'F')
-            streets[name].append(seg)
-            i += 1
-            if i % 1000 == 0:
-                sys.stderr.write('Loading %d\n' % i)
-    return streets
+        if not name:
+            continue
+        coords = numpy.array(pt['geometry']['coordinates'], dtype=numpy.float64)
+        length = float(shapely.length(shapely.linestrings(coords)))
+        yield (name, pt['properties']['osm_id'],
+               pt['properties'].get('oneway', 'B') == 'F', length, coords)
+        i += 1
+        if i % 1000 == 0:
+            sys.stderr.write('Loading %d\n' % i)
 
 
-def cluster_streets(streets):
+def write_run(records, directory):
+    records.sort(key=lambda record: record[:2])
+    fd, filename = tempfile.mkstemp(suffix='.run', dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        for record in records:
+            pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+    return filename
+
+
+def read_run(filename):
+    with open(filename, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def partition_ways(ways, directory, chunk_size=CHUNK_SIZE):
+    '''
+    Writes ways to run files in directory, each sorted by the first
+    appearance of the street name and then by input order. Returns the
+    run filenames.
+    '''
+    ranks = {}
+    runs, records = [], []
+    for seq, (name, osmid, oneway, length, coords) in enumerate(ways):
+        rank = ranks.setdefault(name, len(ranks))
+        records.append((rank, seq, name, osmid, oneway, length, coords.tobytes()))
+        if len(records) >= chunk_size:
+            runs.append(write_run(records, directory))
+            records = []
+    if records:
+        runs.append(write_run(records, directory))
+    return runs
+
+
+def collect_streets(shp, directory, chunk_size=CHUNK_SIZE):
     '''
-    Self-made clustering, certainly bad. But works.
+    Yields (name, segments) per street name in order of first
+    appearance, reading back only one street's ways at a time.
     '''
-    for s in streets:
+    runs = partition_ways(read_ways(shp), directory, chunk_size)
+    merged = heapq.merge(*[read_run(run) for run in runs], key=lambda record: record[:2])
+    for _, records in groupby(merged, key=lambda record: record[0]):
+        segments = [
+            StreetSegment(osmid, name,
+                          numpy.frombuffer(coords, dtype=numpy.float64).reshape(-1, 2),
+                          length, oneway=oneway)
+            for _, _, name, osmid, oneway, length, coords in records
+        ]
+        yield segments[0].name, segments
+
+
+def get_close_segment_pairs(segments, max_km=MAX_DISTANCE_KM):
+    '''
+    Yields index pairs of segments with vertices closer than max_km.
+    Vertices are bucketed into a grid with the threshold as cell size,
+    so only vertices in neighbouring cells are compared.
+    '''
+    vertices = [s.vertices() for s in segments]
+    owners = numpy.concatenate([numpy.full(len(v), i) for i, v in enumerate(vertices)])
+    vertices = numpy.concatenate(vertices)
+    max_chord = get_chord(max_km)
+
+    cells = numpy.floor(vertices / max_chord).astype(numpy.int64)
+    cell_keys, cell_index = numpy.unique(cells, axis=0, return_inverse=True)
+    cell_index = cell_index.reshape(-1)
+    order = numpy.argsort(cell_index, kind='stable')
+    bounds = numpy.searchsorted(cell_index[order], numpy.arange(len(cell_keys) + 1))
+    grid = {
+        tuple(key): order[bounds[i]:bounds[i + 1]]
+        for i, key in enumerate(cell_keys)
+    }
+
+    for key, members in grid.items():
+        neighbours = [grid[n] for n in map(tuple, NEIGHBOUR_CELLS + key) if n in grid]
+        others = numpy.concatenate(neighbours)
+        deltas = vertices[members][:, numpy.newaxis, :] - vertices[others][numpy.newaxis, :, :]
+        close_a, close_b = numpy.nonzero((deltas ** 2).sum(axis=2) < max_chord ** 2)
+        pairs = numpy.column_stack((owners[members[close_a]], owners[others[close_b]]))
+        pairs = pairs[pairs[:, 0] < pairs[:, 1]]
+        for a, b in numpy.unique(pairs, axis=0):
+            yield int(a), int(b)
+
+
+def cluster_segments(segments, max_km=MAX_DISTANCE_KM):
+    '''
+    Merges segments into clusters of segments connected by vertices
+    closer than max_km (single linkage). Each cluster is merged into
+    its first segment.
+    '''
+    if len(segments) < 2:
+        return list(segments)
+    union_find = UnionFind(len(segments))
+    for a, b in get_close_segment_pairs(segments, max_km):
+        union_find.union(a, b)
+    neighbours = defaultdict(set)
+    for a, b in get_close_segment_pairs(segments, max_km):
+        union_find.union(a, b)
+        neighbours[a].add(b)
+        neighbours[b].add(a)
+    clusters = OrderedDict()
+    for i in range(len(segments)):
+        clusters.setdefault(union_find.find(i), []).append(i)
+    return [merge_cluster(segments, members, neighbours) for members in clusters.values()]
+
+
+def merge_cluster(segments, members, neighbours):
+    '''
+    Merges the segments of one cluster in the order of pairwise merge
+    passes: each segment in turn absorbs every later segment that is
+    close to what it holds so far, until nothing merges any more. This
+    keeps the order of parts and of the length sums of earlier output.
+    '''
+    cluster = [(segments[i], {i}, neighbours[i] | {i}) for i in members]
+    merging = True
+    while merging:
+        merging = False
+        i = 0
+        while i < len(cluster):
+            segment, held, close = cluster[i]
+            rest = []
+            for other in cluster[i + 1:]:
+                if close & other[1]:
+                    segment.merge(other[0])
+                    held |= other[1]
+                    close |= other[2]
+                    merging = True
+                else:
+                    rest.append(other)
+            cluster[i + 1:] = rest
+            i += 1
+    return cluster[0][0]
+
+
+def cluster_streets(streets):
+    for s, segments in streets:
         sys.stderr.write(u'Clustering %s\n' % s)
-        merging = True
-        cluster = list(streets[s])
-        new_cluster = []
-        while merging:
-            merging = False
-            i = 0
-            while i < len(cluster):
-                a = cluster[i]
-                new_cluster = cluster[:(i + 1)]
-                for b in cluster[(i + 1):]:
-                    merged = a.try_merge(b)
-                    if merged is not None:
-                        merging = True
-                    else:
-                        new_cluster.append(b)
-                cluster = new_cluster
-                i += 1
-        yield (s, cluster)
+        yield (s, cluster_segments(segments))
 
 
 def main(shapefile):
-    with fiona.open(shapefile, 'r') as shp:
-        streets = collect_streets(shp)
-
-    sys.stderr.write(u'Dumping...\n')
     sys.stdout.write('''{"type":"FeatureCollection","features":[''')
 
     first = True
-    for street, segments in cluster_streets(streets):
-        for segment in segments:
-            if first:
-                first = False
-            else:
-                sys.stdout.write(',')
-            json.dump(segment.geojson(), sys.stdout)
+    with fiona.open(shapefile, 'r') as shp, tempfile.TemporaryDirectory() as tmpdir:
+        for street, segments in cluster_streets(collect_streets(shp, tmpdir)):
+            for segment in segments:
+                if first:
+                    first = False
+                else:
+                    sys.stdout.write(',')
+                json.dump(segment.geojson(), sys.stdout)
     sys.stdout.write(']}')
 
 
@@ -0,0 +1,50 @@
+'''
+Police directorate lookup for geocoded accident centers.
+
+The directorate polygons are prepared once and kept in an STRtree, so
+the centers of a whole table are assigned with one bounding box query
+and one vectorized point-in-polygon test over the candidate pairs.
+Points on a shared border go to the first directorate of the file.
+'''
+import numpy
+import shapely
+from shapely.strtree import STRtree
+
+
+class DirectorateIndex(object):
+    def __init__(self, districts):
+        self.names = list(districts)
+        self.geometries = numpy.array([districts[name] for name in self.names], dtype=object)
+        shapely.prepare(self.geometries)
+        self.tree = STRtree(self.geometries)
+
+    def assign(self, x, y):
+        '''
+        Index into names of the directorate containing each point, -1
+        for points outside all directorates or with NaN coordinates.
+        '''
+        x = numpy.asarray(x, dtype=numpy.float64)
+        y = numpy.asarray(y, dtype=numpy.float64)
+        assigned = numpy.full(len(x), len(self.names), dtype=numpy.int64)
+        valid = numpy.flatnonzero(~(numpy.isnan(x) | numpy.isnan(y)))
+        if len(valid):
+            points, candidates = self.tree.query(shapely.points(x[valid], y[valid]))
+            rows = valid[points]
+            hits = shapely.intersects_xy(self.geometries[candidates], x[rows], y[rows])
+            numpy.minimum.at(assigned, rows[hits], candidates[hits])
+        assigned[assigned == len(self.names)] = -1
+        return assigned
+
+    def check(self, accidents):
+        '''
+        Directorate of every row's center (index into names or -1) and a
+        mask of the rows whose center lies outside the directorate the
+        CSV states. Rows without center or with a directorate that has
+        no polygon (e.g. historic ones) are never flagged.
+        '''
+        assigned = self.assign(accidents.center_x, accidents.center_y)
+        codes = {name: i for i, name in enumerate(self.names)}
+        stated = numpy.array([codes.get(d, -1) for d in accidents.directorates],
+                             dtype=numpy.int64)[accidents.directorate]
+        mismatch = (stated >= 0) & accidents.has_center & (assigned != stated)
+        return assigned, mismatch
@@ -1,41 +1,113 @@
 import argparse
+import asyncio
+import hashlib
 import json
 from collections import defaultdict, Counter, OrderedDict
 import re
 import csv
+from functools import lru_cache
+from itertools import chain
+import multiprocessing
 import os
+import queue
 import sys
-
-from sqlalchemy import create_engine
-
-from shapely.geometry import shape, MultiPoint
-from shapely import wkt
+import threading
+
+import numpy
+import shapely
+from shapely.geometry import shape, MultiPoint, Point
+from shapely.strtree import STRtree
+
+from accident_table import AccidentTable
+from geocode_cache import GeocodeCache
+from geometry import BACKENDS, LengthCache, get_geometry_backend
+from lod import LOD_ZOOMS, LodStore, simplify_shapes
+from directorates import DirectorateIndex
+from name_index import TrigramIndex
+from postgis import AsyncPostGISGeometry
+from server import serve
+from snapshot import read_snapshot, write_snapshot
+from stats import stats
+from writers import (BINARY_FORMATS, GEOJSON_FORMATS, OUTPUT_WRITER, GeometryCache,
+                     open_output)
 
 
 NON_LOWER_RE = re.compile('[^a-z]|aße$|asse$')
 MAX_YEAR = 2018
-
-
+# Street strings outside the interned table of the CSVs
+NAME_CACHE_SIZE = 4096
+# Lowest confidence of a suggested name for a lost street
+MIN_CONFIDENCE = 0.7
+
+STREETS_FILENAME = 'geo/berlin_streets.geojson'
+DISTRICTS_FILENAME = 'geo/polizeidirektionen.geojson'
+MAPPING_FILENAME = 'geo/missing_mapping.json'
+DISTRICT_HISTORY_FILENAME = 'geo/policedistrict_historic.json'
+INDEX_FILENAME = 'geo/berlin_streets.idx'
+LENGTH_CACHE_FILENAME = 'geo/berlin_streets.lengths.sqlite'
+GEOCODE_CACHE_FILENAME = 'geo/berlin_streets.geocode.sqlite'
+LOD_STORE_FILENAME = 'geo/berlin_streets.lod.sqlite'
+
+
+@lru_cache(maxsize=NAME_CACHE_SIZE)
 def make_name(name):
     if '(' in name:
         name = name[:name.index('(')].strip()
-    return NON_LOWER_RE.sub('', name.lower().replace('ß', 'ss'))
+    return sys.intern(NON_LOWER_RE.sub('', name.lower().replace('ß', 'ss')))
+
+
+@lru_cache(maxsize=NAME_CACHE_SIZE)
+def split_street(street):
+    return tuple(OrderedDict([(p.strip(), None) for p in street.split(' / ')]).keys())
 
 
 def clean_street(street):
-    parts = street.split(' / ')
-    return list(OrderedDict([(p.strip(), None) for p in parts]).keys())
+    return list(split_street(street))
 
 
-class GeoIndex(object):
-    def __init__(self, filename, district_filename, engine_config,
-                 mapping=None, district_history=None):
-        with open(filename) as f:
-            streets = json.load(f)
-        with open(district_filename) as f:
-            districts = json.load(f)
+def get_index_version(*parts):
+    version = hashlib.sha1()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = json.dumps(part, sort_keys=True).encode('utf-8')
+        version.update(part)
+    return version.hexdigest()
 
-        self.engine = create_engine(engine_config)
+
+class GeoIndex(object):
+    # STRtree over all feature shapes, built on first use
+    _tree = None
+    # GeometryCache per level of detail (None for full geometries)
+    _geometry_caches = None
+    # Simplified shapes per zoom level
+    _lod_shapes = None
+    # Optional LodStore consulted by get_lod_shapes
+    lod_store = None
+    # TrigramIndex over the name keys, built on first use
+    _name_index = None
+    # DirectorateIndex over the district polygons, built on first use
+    _directorate_index = None
+    # Optional GeocodeCache consulted by get_accidents_for_year
+    geocode_cache = None
+    # Raw CSV street string -> (streets, names, name keys), see resolve_streets
+    street_names = None
+
+    def __init__(self, filename, district_filename, geometry,
+                 mapping=None, district_history=None, length_cache=None):
+        with stats.timer('index.load_json'):
+            with open(filename, 'rb') as f:
+                streets_data = f.read()
+            with open(district_filename, 'rb') as f:
+                districts_data = f.read()
+            streets = json.loads(streets_data.decode('utf-8'))
+            districts = json.loads(districts_data.decode('utf-8'))
+
+        self.geometry = geometry
+        # Renames in the mapping do not change feature indices or
+        # geometries, so only point mappings are part of the version
+        point_mapping = {k: v for k, v in (mapping or {}).items() if isinstance(v, list)}
+        self.version = get_index_version(streets_data, districts_data,
+                                         point_mapping, district_history)
 
         self.features = streets['features']
 
@@ -60,18 +132,51 @@ class GeoIndex(object):
                 self.mapping[make_name(k)] = make_name(mapping[k])
 
         self.lost_streets = Counter()
+        self.closest_points = {}
 
         self.districts = {}
         for feature in districts['features']:
             self.districts[feature['properties']['spatial_name']] = shape(feature['geometry'])
 
-        self.shapes = [shape(feature['geometry']) for feature in self.features]
+        with stats.timer('index.shapes'):
+            self.shapes = [shape(feature['geometry']) for feature in self.features]
         print('Calculating lengths...', file=sys.stderr)
-        self.shape_lengths = [self.get_shape_length(s) for s in self.shapes]
+        with stats.timer('index.lengths'):
+            if length_cache is None:
+                self.shape_lengths = self.geometry.get_feature_lengths(
+                    self.shapes, range(len(self.shapes)))
+            else:
+                self.shape_lengths = length_cache.get_shape_lengths(self.shapes, self.geometry)
         print('Done Calculating lengths...', file=sys.stderr)
-        self.names = defaultdict(list)
-        for i, feature in enumerate(self.features):
-            self.names[make_name(feature['properties']['name'])].append(i)
+        with stats.timer('index.names'):
+            self.names = defaultdict(list)
+            for i, feature in enumerate(self.features):
+                self.names[make_name(feature['properties']['name'])].append(i)
+        with stats.timer('index.best_candidates'):
+            self.best_candidates = self.get_best_candidates()
+
+    @classmethod
+    def from_snapshot(cls, filename, geometry, snapshot=None):
+        if snapshot is None:
+            with stats.timer('index.load_snapshot'):
+                snapshot = read_snapshot(filename)
+        if snapshot['backend'] != geometry.name:
+            raise Exception('Lengths in %s were measured with the %s backend, '
+                            'run build-index again' % (filename, snapshot['backend']))
+        idx = cls.__new__(cls)
+        idx.geometry = geometry
+        idx.version = snapshot['version']
+        idx.features = snapshot['features']
+        idx.shapes = snapshot['shapes']
+        idx.shape_lengths = snapshot['shape_lengths']
+        idx.names = snapshot['names']
+        idx.best_candidates = snapshot['best_candidates']
+        idx.mapping = snapshot['mapping']
+        idx.districts = snapshot['districts']
+        idx.district_history = {k: Point(v) for k, v in snapshot['district_history'].items()}
+        idx.lost_streets = Counter()
+        idx.closest_points = {}
+        return idx
 
     def get_weighted_streets(self, year):
         for feat, count in self.street_counter.items():
@@ -86,75 +191,198 @@ class GeoIndex(object):
                 "geometry": self.features[feat]['geometry']
             }
 
-    def find_by_name(self, original_name, district=None, year=None):
+    def find_by_name(self, original_name, district=None, year=None, name=None):
         if district:
             if district not in self.districts and district not in self.district_history:
                 raise Exception('Missing district %s' % district)
-
-            if district in self.districts:
-                district = self.districts[district]
-            else:
-                district = self.district_history[district]
         else:
             district = None
 
-        name = make_name(original_name)
-
+        if name is None:
+            name = make_name(original_name)
         if name in self.mapping:
+            stats.incr('lookup.mapping')
             name = self.mapping[name]
 
         if name in self.names:
-            candidates = [i for i in self.names[name]]
+            candidates = self.names[name]
             if len(candidates) > 1:
-                return self.get_best_for_district(candidates, district)
+                stats.incr('lookup.district')
+                if district is None:
+                    return self.get_best_for_district(candidates)
+                return self.best_candidates[name][district]
             if candidates:
+                stats.incr('lookup.direct')
                 return candidates[0]
+        stats.incr('lookup.lost')
         self.lost_streets[original_name] += 1
         return None
 
+    @property
+    def name_index(self):
+        if self._name_index is None:
+            with stats.timer('index.name_index'):
+                self._name_index = TrigramIndex(self.names.keys())
+        return self._name_index
+
+    @property
+    def directorate_index(self):
+        if self._directorate_index is None:
+            with stats.timer('index.directorate_index'):
+                self._directorate_index = DirectorateIndex(self.districts)
+        return self._directorate_index
+
+    def suggest_name(self, original_name, min_confidence=MIN_CONFIDENCE):
+        '''
+        Feature name of the closest known street to a lost street name
+        and the confidence of the match, or None.
+        '''
+        with stats.timer('lookup.suggest'):
+            matches = self.name_index.search(make_name(original_name))
+        if not matches or matches[0][1] < min_confidence:
+            return None
+        name, confidence, _ = matches[0]
+        feature = self.features[self.names[name][0]]
+        return feature['properties']['name'], confidence
+
+    def resolve_streets(self, raw_streets):
+        '''
+        Adds the split streets, normalized names and mapped name keys of
+        all distinct raw street strings to the street_names table, so a
+        row needs a single lookup.
+        '''
+        if self.street_names is None:
+            self.street_names = {}
+        for raw in set(raw_streets) - self.street_names.keys():
+            streets = split_street(raw)
+            names = tuple(make_name(street) for street in streets)
+            keys = tuple(self.mapping.get(name, name) for name in names)
+            self.street_names[raw] = (streets, names, keys)
+
     def get_best_for_district(self, candidates, district=None):
         if district is None and len(candidates) > 1:
             raise Exception('More than one candidate, but no district: %s' %
                 [self.features[x]['properties']['name'] for x in candidates])
-        new_candidates = []
-        for candidate in candidates:
-            candidate_shape = self.shapes[candidate]
-            if district is None:
-                new_candidates.append((float('infinity'), candidate))
+        if district is None:
+            return candidates[0]
+        distances = shapely.distance(district, [self.shapes[c] for c in candidates])
+        return candidates[int(numpy.argmin(distances))]
+
+    def get_best_candidates(self):
+        '''
+        Precomputes the closest candidate for every district and every
+        name that belongs to more than one feature.
+        '''
+        district_shapes = dict(self.district_history)
+        district_shapes.update(self.districts)
+        district_keys = list(district_shapes.keys())
+        district_array = numpy.array([district_shapes[k] for k in district_keys])[:, numpy.newaxis]
+        best_candidates = {}
+        for name, candidates in self.names.items():
+            if len(candidates) < 2:
+                continue
+            distances = shapely.distance(district_array,
+                                         numpy.array([self.shapes[c] for c in candidates]))
+            best = numpy.argmin(distances, axis=1)
+            best_candidates[name] = {
+                key: candidates[int(i)] for key, i in zip(district_keys, best)
+            }
+        return best_candidates
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = STRtree(list(self.shapes))
+        return self._tree
+
+    @property
+    def geometry_cache(self):
+        return self.get_geometry_cache()
+
+    def get_geometry_cache(self, lod=None):
+        if self._geometry_caches is None:
+            self._geometry_caches = {}
+        if lod not in self._geometry_caches:
+            shapes = None if lod is None else self.get_lod_shapes(lod)
+            self._geometry_caches[lod] = GeometryCache(self.features, shapes)
+        return self._geometry_caches[lod]
+
+    def get_lod_shapes(self, zoom):
+        '''
+        All shapes simplified for the web map zoom level.
+        '''
+        if self._lod_shapes is None:
+            self._lod_shapes = {}
+        if zoom not in self._lod_shapes:
+            if self.lod_store is not None:
+                shapes = self.lod_store.get_shapes(self.version, zoom, self.shapes)
             else:
-                new_candidates.append((district.distance(candidate_shape), candidate))
-        new_candidates.sort(key=lambda x: x[0])
-        return new_candidates[0][1]
-
-    def get_st_closest_point(self, a, b):
-        result = self.engine.execute('''SELECT
-            ST_AsText(ST_ClosestPoint(foo.a, foo.b)) AS a_b,
-            ST_AsText(ST_ClosestPoint(foo.b, foo.a)) As b_a
-            FROM (
-                SELECT '%s'::geometry As a, '%s'::geometry As b
-                ) AS foo;''' % (
-            a.wkt, b.wkt
-        )).fetchall()
-        return wkt.loads(result[0][0]), wkt.loads(result[0][1])
+                shapes = simplify_shapes(self.shapes, zoom)
+            self._lod_shapes[zoom] = shapes
+        return self._lod_shapes[zoom]
+
+    def find_nearest(self, geom, max_distance=None):
+        '''
+        Index of the feature nearest to geom or None if there is none
+        within max_distance (in degrees).
+        '''
+        nearest = self.tree.query_nearest(geom, max_distance=max_distance)
+        if not len(nearest):
+            return None
+        return int(nearest[0])
+
+    def get_closest_points(self, a, b=None):
+        '''
+        Closest points between feature a and feature b (or the centroid
+        of a if b is None), memoized by feature index pair.
+        '''
+        if (a, b) not in self.closest_points:
+            if b is not None and (b, a) in self.closest_points:
+                closest_b, closest_a = self.closest_points[(b, a)]
+                return closest_a, closest_b
+            self.prefetch_closest_points([(a, b)])
+        return self.closest_points[(a, b)]
+
+    def get_missing_closest_points(self, pairs):
+        pairs = list(OrderedDict.fromkeys(pairs))
+        missing = [p for p in pairs
+                   if p not in self.closest_points and
+                   (p[1] is None or (p[1], p[0]) not in self.closest_points)]
+        stats.incr('closest_points.hit', len(pairs) - len(missing))
+        stats.incr('closest_points.miss', len(missing))
+        return missing
+
+    def prefetch_closest_points(self, pairs):
+        missing = self.get_missing_closest_points(pairs)
+        if not missing:
+            return
+        results = self.geometry.get_closest_points_many(missing, self.shapes)
+        self.closest_points.update(zip(missing, results))
+
+    async def prefetch_closest_points_async(self, pairs, geometry):
+        missing = self.get_missing_closest_points(pairs)
+        if not missing:
+            return
+        results = await geometry.get_closest_points_many(missing, self.shapes)
+        self.closest_points.update(zip(missing, results))
 
     def get_shape_length(self, shape):
-        result = self.engine.execute('''SELECT ST_Length(the_geog) As length_spheroid,
-                                               ST_Length(the_geog, false) As length_sphere
-                        FROM (
-                            SELECT ST_GeographyFromText(
-                            'SRID=4326;%s')
-                        As the_geog)
-                        As foo;''' % (shape.wkt)).fetchall()
+        return self.geometry.get_shape_length(shape)
 
-        return result[0][0]
+    def find_features(self, streets, district=None, year=None):
+        features = [self.find_by_name(street, district, year) for street in streets]
+        return [feature for feature in features if feature is not None]
 
-    def get_georeference(self, streets, district=None, year=None):
+    def get_georeference(self, streets, district=None, year=None, features=None):
         len_streets = len(streets)
 
-        features = [self.find_by_name(street, district, year) for street in streets]
-        features = [feature for feature in features if feature is not None]
+        if features is None:
+            features = self.find_features(streets, district, year)
 
         center = self.get_center(features, len_streets)
+        return self.make_georeference(streets, features, center)
+
+    def make_georeference(self, streets, features, center):
         return {
             'streets': streets,
             'center': center,
@@ -162,12 +390,19 @@ class GeoIndex(object):
             'feature_idx': features
         }
 
+    def get_center_pairs(self, features, len_streets):
+        if len(features) > 1:
+            return list(zip(features[:-1], features[1:]))
+        if len(features) == 1 and len_streets == 1:
+            return [(features[0], None)]
+        return []
+
     def get_center(self, features, len_streets):
         if len(features) > 1:
             mid_points = []
             # FIXME: make this more robust
-            for a, b in zip(features[:-1], features[1:]):
-                closest_a, closest_b = self.get_st_closest_point(self.shapes[a], self.shapes[b])
+            for a, b in self.get_center_pairs(features, len_streets):
+                closest_a, closest_b = self.get_closest_points(a, b)
                 mid_points.append(((closest_a.x + closest_b.x) / 2, (closest_a.y + closest_b.y) / 2))
             center = MultiPoint(mid_points).centroid
             return center
@@ -178,132 +413,177 @@ class GeoIndex(object):
         feat = features[0]
 
         if len_streets == 1:
-            center = self.shapes[feat].centroid
-            a, _ = self.get_st_closest_point(self.shapes[feat], center)
+            a, _ = self.get_closest_points(feat)
             return a
 
         if len_streets > 1:
             mid_point = self.shapes[feat].centroid
             return mid_point
 
-    def get_accidents_for_year(self, year):
-        reader = csv.DictReader(open('csvs/%d.csv' % year))
-        for lineno, line in enumerate(reader, start=1):
-            if not line['directorate']:
+    def read_year(self, year):
+        '''
+        Matches the streets of all rows of a year. Returns the rows as
+        (line, streets, features, center) with center None for rows not
+        found in the geocode cache, and (row index, names, lost) for
+        those rows.
+        '''
+        with open('csvs/%d.csv' % year) as f:
+            lines = list(csv.DictReader(f))
+        with stats.timer('geocode.resolve_streets'):
+            self.resolve_streets(line['street'] for line in lines)
+        rows = []
+        new_rows = []
+        for lineno, line in enumerate(lines, start=1):
+            directorate = line['directorate']
+            if not directorate:
                 print(year, lineno, line, file=sys.stderr)
-            streets = clean_street(line['street'])
-            geo_data = self.get_georeference(streets,
-                                             district=line['directorate'],
-                                             year=year)
+            streets, street_names, keys = self.street_names[line['street']]
+            streets = list(streets)
+            names = None
+            cached = None
+            if self.geocode_cache is not None:
+                names = list(keys)
+                cached = self.geocode_cache.get(directorate, names)
+            if cached is not None:
+                stats.incr('geocode_cache.hit')
+                features, center, lost = cached
+                self.lost_streets.update(streets[i] for i in lost)
+                rows.append((line, streets, features, center))
+                continue
+            if self.geocode_cache is not None:
+                stats.incr('geocode_cache.miss')
+            found = [self.find_by_name(street, directorate, year, name=name)
+                     for street, name in zip(streets, street_names)]
+            features = [feature for feature in found if feature is not None]
+            lost = [i for i, feature in enumerate(found) if feature is None]
+            rows.append((line, streets, features, None))
+            new_rows.append((len(rows) - 1, names, lost))
+        return rows, new_rows
+
+    def get_year_center_pairs(self, rows, new_rows):
+        for i, _, _ in new_rows:
+            yield from self.get_center_pairs(rows[i][2], len(rows[i][1]))
+
+    def finish_year(self, year, rows, new_rows):
+        for i, _, _ in new_rows:
+            line, streets, features, _ = rows[i]
+            rows[i] = (line, streets, features, self.get_center(features, len(streets)))
+
+        if self.geocode_cache is not None:
+            self.geocode_cache.set_many(
+                (rows[i][0]['directorate'], names, rows[i][2], rows[i][3], lost)
+                for i, names, lost in new_rows
+            )
+
+        for line, streets, features, center in rows:
+            geo_data = self.make_georeference(streets, features, center)
             geo_data['year'] = year
             geo_data.update(line)
             yield geo_data
 
+    def get_accidents_for_year(self, year):
+        rows, new_rows = self.read_year(year)
+        # Resolve all closest points of this year in one batch
+        self.prefetch_closest_points(self.get_year_center_pairs(rows, new_rows))
+        yield from self.finish_year(year, rows, new_rows)
+
+    async def get_accidents_for_year_async(self, year, geometry):
+        '''
+        Like get_accidents_for_year, but closest points come from an
+        asyncio geometry backend that runs batches concurrently.
+        '''
+        rows, new_rows = self.read_year(year)
+        await self.prefetch_closest_points_async(
+            self.get_year_center_pairs(rows, new_rows), geometry)
+        return list(self.finish_year(year, rows, new_rows))
+
     def get_accidents(self, years):
         for year in years:
             yield from self.get_accidents_for_year(year)
 
 
-def write_geojson(fh, generator):
-    fh.write('{"type":"FeatureCollection","features":[')
-    first = True
-    for feat in generator:
-        if first:
-            first = False
-        else:
-            fh.write(',')
-        json.dump(feat, fh)
-
-    fh.write(']}')
-
-
-def write_csv(fh, generator):
-    writer = None
-    for x in generator:
-        if writer is None:
-            writer = csv.DictWriter(fh, list(x.keys()))
-            writer.writeheader()
-        writer.writerow(x)
-
-
 def get_accident_feature(accident):
     return {
         "type": "Feature",
         "properties": {
             "name": accident['street'],
-            "year": int(accident['year']),
-            "count": int(accident['count']),
+            "year": accident['year'],
+            "count": accident['count'],
             "directorate": accident['directorate'],
-            "street_count": len(accident['streets'])
+            "street_count": accident['street_count']
         }
     }
 
 
+def get_point_feature(accident):
+    acc_feat = get_accident_feature(accident)
+    acc_feat['geometry'] = {
+          "type": "Point",
+          "coordinates": list(accident['center'])
+    }
+    return acc_feat
+
+
+def get_line_feature(idx, feat_id, count):
+    feat = idx.features[feat_id]
+    length = idx.shape_lengths[feat_id]
+    if not length:
+        count_by_length = None
+    else:
+        count_by_length = count / length
+    return {
+        "type": "Feature",
+        "properties": {
+            "name": feat['properties']['name'],
+            "length": length,
+            "count": count,
+            "count_by_length": count_by_length
+        },
+        "geometry_id": feat_id
+    }
+
+
+def get_feature_key(idx, feature_idx):
+    return '-'.join(str(x) for x in sorted(int(idx.features[f]['properties']['osmid']) for f in feature_idx))
+
+
 def get_accidents_as_points(idx, accidents):
-    for accident in accidents:
-        center = accident['center']
-        if center is None:
+    for accident in accidents.rows():
+        if accident['center'] is None:
             continue
-        acc_feat = get_accident_feature(accident)
-        acc_feat['geometry'] = {
-              "type": "Point",
-              "coordinates": [center.x, center.y]
-        }
-        yield acc_feat
+        yield get_point_feature(accident)
 
 
 def get_accidents_as_lines(idx, accidents):
-    accidents_by_feature = defaultdict(int)
-    for accident in accidents:
-        for feat_id in accident['feature_idx']:
-            accidents_by_feature[feat_id] += int(accident['count'])
-
-    for feat_id, count in accidents_by_feature.items():
-        feat = idx.features[feat_id]
-        length = idx.shape_lengths[feat_id]
-        if not length:
-            count_by_length = None
-        else:
-            count_by_length = count / length
-        yield {
-            "type": "Feature",
-            "properties": {
-                "name": feat['properties']['name'],
-                "length": length,
-                "count": count,
-                "count_by_length": count_by_length
-            },
-            "geometry": feat['geometry']
-        }
-    #
-    # for accident in accidents:
-    #     for feat_id, feat in zip(accident['feature_idx'], accident['features']):
-    #         acc_feat = get_accident_feature(accident)
-    #         acc_feat['geometry'] = feat['geometry']
-    #         yield acc_feat
+    feature_ids, counts = accidents.sum_by_feature()
+    for feat_id, count in zip(feature_ids.tolist(), counts.tolist()):
+        yield get_line_feature(idx, feat_id, count)
 
 
 def get_accidents_as_features(idx, accidents):
-    for accident in accidents:
-        if len(accident['features']) > 1:
-            yield from get_accidents_as_points(idx, [accident])
+    for accident in accidents.rows():
+        if len(accident['feature_idx']) > 1:
+            if accident['center'] is not None:
+                yield get_point_feature(accident)
         else:
-            yield from get_accidents_as_lines(idx, [accident])
+            for feat_id in accident['feature_idx']:
+                yield get_line_feature(idx, feat_id, accident['count'])
 
 
 def get_accident_list(idx, accidents):
-    for accident in accidents:
+    for accident in accidents.rows():
         center = accident['center']
         if center is None:
             continue
 
+        feature_idx = accident['feature_idx']
         oneway_ratio = None
         ride_length = None
         shape_length = None
-        if len(accident['features']) == 1:
-            props = idx.features[accident['feature_idx'][0]]['properties']
+        if len(feature_idx) == 1:
+            props = idx.features[feature_idx[0]]['properties']
             oneway_ratio = props.get('oneway_length', 0) / props.get('total_length', 1)
-            shape_length = idx.shape_lengths[accident['feature_idx'][0]]
+            shape_length = idx.shape_lengths[feature_idx[0]]
             # Count full non-oneway street as double (both directions)
             ride_length = (2 - oneway_ratio) * shape_length
 
@@ -312,25 +592,27 @@ def get_accident_list(idx, accidents):
             'count': accident['count'],
             'year': accident['year'],
             'directorate': accident['directorate'],
-            'lat': center.x,
-            'lng': center.y,
+            'lat': center[0],
+            'lng': center[1],
             'oneway_ratio': oneway_ratio,
-            'feature_count': len(accident['features']),
+            'feature_count': len(feature_idx),
             'feature_length': shape_length,
             'ride_length': ride_length,
-            'features': '-'.join(str(x) for x in sorted(int(x['properties']['osmid']) for x in accident['features']))
+            'features': get_feature_key(idx, feature_idx)
         }
 
 
 def get_accident_list_split(idx, accidents):
-    for accident in accidents:
+    for accident in accidents.rows():
         center = accident['center']
         if center is None:
             continue
 
-        count = len(accident['features'])
+        feature_idx = accident['feature_idx']
+        count = len(feature_idx)
+        features = get_feature_key(idx, feature_idx)
 
-        for feat in accident['feature_idx']:
+        for feat in feature_idx:
             props = idx.features[feat]['properties']
             oneway_ratio = props.get('oneway_length', 0) / props.get('total_length', 1)
             shape_length = idx.shape_lengths[feat]
@@ -339,24 +621,24 @@ def get_accident_list_split(idx, accidents):
 
             yield {
                 'street': accident['street'],
-                'single_street': idx.features[feat]['properties']['name'],
-                'count': int(accident['count']) / count,
+                'single_street': props['name'],
+                'count': accident['count'] / count,
                 'year': accident['year'],
                 'directorate': accident['directorate'],
-                'lat': center.x,
-                'lng': center.y,
+                'lat': center[0],
+                'lng': center[1],
                 'oneway_ratio': oneway_ratio,
                 'feature_count': count,
                 'feature_length': shape_length,
                 'ride_length': ride_length,
-                'features': '-'.join(str(x) for x in sorted(int(x['properties']['osmid']) for x in accident['features'])),
-                'single_feature': idx.features[feat]['properties']['osmid']
+                'features': features,
+                'single_feature': props['osmid']
             }
 
 
 def get_accident_street_list(idx, accidents):
-    for accident in accidents:
-        if not accident['features']:
+    for accident in accidents.rows():
+        if not accident['feature_idx']:
             yield {
                 'osmid': None,
                 'name': accident['street'],
@@ -366,52 +648,58 @@ def get_accident_street_list(idx, accidents):
                 'length': None
             }
             continue
-        for feat_id, feat in zip(accident['feature_idx'], accident['features']):
-            yield {
-                'osmid': feat['properties']['osmid'],
-                'name': feat['properties']['name'],
-                'count': accident['count'],
-                'year': accident['year'],
-                'directorate': accident['directorate'],
-                'length': idx.shape_lengths[feat_id]
-            }
-            break
-
+        feat_id = accident['feature_idx'][0]
+        props = idx.features[feat_id]['properties']
+        yield {
+            'osmid': props['osmid'],
+            'name': props['name'],
+            'count': accident['count'],
+            'year': accident['year'],
+            'directorate': accident['directorate'],
+            'length': idx.shape_lengths[feat_id]
+        }
 
-def time_compare(idx, accidents):
-    YEAR_COUNT = 3.0
-    year_stats = defaultdict(lambda: defaultdict(int))
-    for accident in accidents:
-        for feat_id in accident['feature_idx']:
-            year = int(accident['year'])
-            year_stats[feat_id][year] += int(accident['count'])
 
-    last_year = MAX_YEAR + 1
-    new_years = (last_year - YEAR_COUNT, last_year)
-    old_years = (new_years[0] - YEAR_COUNT, new_years[0])
-    for feat_id, year_stat in year_stats.items():
-        feat = idx.features[feat_id]
-        length = idx.shape_lengths[feat_id]
-        old_years_count = sum(year_stat[y] for y in range(*old_years))
-        new_years_count = sum(year_stat[y] for y in range(*new_years))
-        difference = new_years_count - old_years_count
-        old_mean = old_years_count / YEAR_COUNT
-        new_mean = new_years_count / YEAR_COUNT
-        mean_difference = new_mean - old_mean
-        mean_difference_percent = 100
-        if old_mean > 0:
-            mean_difference_percent = mean_difference / float(old_mean) * 100
-        percent_change = 100
-        if old_years_count > 0:
-            percent_change = difference / float(old_years_count) * 100
-
-        old_relative = old_years_count / length
-        new_relative = new_years_count / length
+def time_compare(idx, accidents, window=3, end_year=MAX_YEAR):
+    '''
+    Compares accident counts per street of the window years up to
+    end_year with the window years before.
+    '''
+    years, feature_ids, counts = accidents.get_year_feature_counts()
+    new_years = (years > end_year - window) & (years <= end_year)
+    old_years = (years > end_year - 2 * window) & (years <= end_year - window)
+    old_count = counts[old_years].sum(axis=0)
+    new_count = counts[new_years].sum(axis=0)
+    lengths = numpy.array([idx.shape_lengths[f] for f in feature_ids.tolist()], dtype=float)
+
+    difference = new_count - old_count
+    old_mean = old_count / window
+    new_mean = new_count / window
+    mean_difference = new_mean - old_mean
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        mean_difference_percent = numpy.where(old_mean > 0, mean_difference / old_mean * 100, 100.0)
+        percent_change = numpy.where(old_count > 0, difference / old_count * 100, 100.0)
+        old_relative = old_count / lengths
+        new_relative = new_count / lengths
         relative_difference = new_relative - old_relative
-        relative_difference_percent = 100
-        if old_relative > 0:
-            relative_difference_percent = relative_difference / float(old_relative) * 100
-
+        relative_difference_percent = numpy.where(
+            old_relative > 0, relative_difference / old_relative * 100, 100.0)
+
+    columns = zip(feature_ids.tolist(), lengths.tolist(), old_count.tolist(),
+                  new_count.tolist(), old_mean.tolist(), new_mean.tolist(),
+                  mean_difference.tolist(), mean_difference_percent.tolist(),
+                  difference.tolist(), percent_change.tolist(), old_relative.tolist(),
+                  new_relative.tolist(), relative_difference.tolist(),
+                  relative_difference_percent.tolist())
+    for (feat_id, length, old_years_count, new_years_count, old_mean, new_mean,
+         mean_difference, mean_difference_percent, difference, percent_change,
+         old_relative, new_relative, relative_difference,
+         relative_difference_percent) in columns:
+        if not length:
+            # Relative values are undefined for streets without length
+            old_relative = new_relative = relative_difference = None
+            relative_difference_percent = None
+        feat = idx.features[feat_id]
         yield {
             "type": "Feature",
             "properties": {
@@ -430,20 +718,21 @@ def time_compare(idx, accidents):
                 "difference": difference,
                 "difference_percent": percent_change
             },
-            "geometry": feat['geometry']
+            "geometry_id": feat_id
         }
 
 
 def get_missing(idx, accidents):
-    for a in accidents:
-        pass
-    for missing in idx.lost_streets.most_common():
+    for name, count in idx.lost_streets.most_common():
+        suggestion, confidence = idx.suggest_name(name) or (None, None)
         yield {
-            'name': missing[0],
-            'original_name': missing[0],
-            'count': missing[1],
+            'name': name,
+            'original_name': name,
+            'count': count,
             'type': 'accidents',
-            'osmid': None
+            'osmid': None,
+            'suggestion': suggestion,
+            'confidence': confidence
         }
     # for feat in idx.features:
     #     yield {
@@ -455,6 +744,29 @@ def get_missing(idx, accidents):
     #     }
 
 
+def get_directorate_mismatches(idx, accidents):
+    '''
+    Rows whose geocoded center lies outside the directorate stated in
+    the CSV, with the directorate the center falls into.
+    '''
+    directorate_index = idx.directorate_index
+    with stats.timer('directorates.check'):
+        assigned, mismatch = directorate_index.check(accidents)
+    stats.incr('directorates.mismatch', int(mismatch.sum()))
+    rows = accidents.select(mismatch).rows()
+    for accident, code in zip(rows, assigned[mismatch].tolist()):
+        yield {
+            'year': accident['year'],
+            'directorate': accident['directorate'],
+            'center_directorate': directorate_index.names[code] if code >= 0 else None,
+            'street': accident['street'],
+            'count': accident['count'],
+            'lng': accident['center'][0],
+            'lat': accident['center'][1],
+            'features': get_feature_key(idx, accident['feature_idx'])
+        }
+
+
 GENERATORS = {
     'accident_points': (get_accidents_as_points, 'geojson'),
     'accident_streets': (get_accidents_as_lines, 'geojson'),
@@ -464,38 +776,438 @@ GENERATORS = {
     'street_list': (get_accident_street_list, 'csv'),
     'missing': (get_missing, 'csv'),
     'time_compare': (time_compare, 'geojson'),
+    'directorate_mismatch': (get_directorate_mismatches, 'csv'),
 }
 
-OUTPUT_WRITER = {
-    'csv': write_csv,
-    'geojson': write_geojson
+# Generators that work row by row and can be written year by year
+STREAMING_GENERATORS = {
+    'accident_points', 'accidents', 'accident_list', 'accident_list_split',
+    'street_list', 'directorate_mismatch'
 }
 
-
-def main(name, years, engine=None):
+# GeoIndex shared with forked worker processes
+_worker_index = None
+
+
+def _init_worker():
+    _worker_index.geometry.dispose()
+    stats.reset()
+
+
+def _geocode_year(year):
+    idx = _worker_index
+    idx.lost_streets = Counter()
+    with stats.timer('geocode.year'):
+        accidents = AccidentTable.from_accidents(idx.get_accidents_for_year(year))
+    worker_stats = stats.to_dict()
+    stats.reset()
+    return year, accidents, idx.lost_streets, worker_stats
+
+
+def geocode_years_async(idx, years, geometry):
+    '''
+    Geocodes years one after another with the closest point batches of
+    each year queried concurrently through an asyncio geometry backend.
+    '''
+    async def run():
+        await geometry.connect()
+        try:
+            results = []
+            for year in years:
+                idx.lost_streets = Counter()
+                with stats.timer('geocode.year'):
+                    accidents = AccidentTable.from_accidents(
+                        await idx.get_accidents_for_year_async(year, geometry))
+                results.append((year, accidents, idx.lost_streets))
+            return results
+        finally:
+            await geometry.close()
+
+    return asyncio.run(run())
+
+
+def geocode_years(idx, years, jobs=1, async_geometry=None):
+    '''
+    Yields (year, AccidentTable, lost_streets) per year in the given order,
+    geocoding years in a pool of forked processes if jobs > 1 or with
+    concurrent queries if an async_geometry backend is given.
+    '''
+    global _worker_index
+
+    if async_geometry is not None:
+        yield from geocode_years_async(idx, years, async_geometry)
+        return
+
+    if jobs <= 1:
+        for year in years:
+            idx.lost_streets = Counter()
+            with stats.timer('geocode.year'):
+                accidents = AccidentTable.from_accidents(idx.get_accidents_for_year(year))
+            yield year, accidents, idx.lost_streets
+        return
+
+    _worker_index = idx
+    context = multiprocessing.get_context('fork')
+    with context.Pool(jobs, initializer=_init_worker) as pool:
+        for year, accidents, lost_streets, worker_stats in pool.imap(_geocode_year, years):
+            stats.merge(worker_stats)
+            yield year, accidents, lost_streets
+
+
+def get_output_format(name, geojson_format='geojson'):
+    format = GENERATORS[name][1]
+    if format == 'geojson':
+        return geojson_format
+    return format
+
+
+def get_output_path(template, name, year=None, geojson_format='geojson'):
+    return template.format(name=name, year=year,
+                           format=get_output_format(name, geojson_format))
+
+
+def write_output(idx, name, accidents, path=None, precision=None,
+                 geojson_format='geojson', compress=None, generator_options=None,
+                 lod=None):
+    '''
+    Writes the output of generator name for an AccidentTable or, for
+    streaming generators, an iterable of tables.
+    '''
+    processor = GENERATORS[name][0]
+    format = get_output_format(name, geojson_format)
+    options = (generator_options or {}).get(name, {})
+    if isinstance(accidents, AccidentTable):
+        processed = processor(idx, accidents, **options)
+    else:
+        processed = chain.from_iterable(processor(idx, table, **options) for table in accidents)
+    if path is not None:
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+    with stats.timer('output.%s' % name):
+        with open_output(path, binary=format in BINARY_FORMATS, compress=compress) as fh:
+            OUTPUT_WRITER[format](fh, processed, precision=precision,
+                                  geometries=idx.get_geometry_cache(lod))
+
+
+class StreamingOutput(object):
+    '''
+    Writes a streaming generator in a thread that is fed one
+    AccidentTable per year, so rows are written while later years are
+    still geocoded.
+    '''
+    def __init__(self, idx, name, path=None, **options):
+        self.queue = queue.Queue(maxsize=2)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, args=(idx, name, path),
+                                       kwargs=options, daemon=True)
+        self.thread.start()
+
+    def get_tables(self):
+        while True:
+            table = self.queue.get()
+            if table is None:
+                return
+            yield table
+
+    def run(self, idx, name, path, **options):
+        tables = self.get_tables()
+        try:
+            write_output(idx, name, tables, path=path, **options)
+        except Exception as e:
+            self.error = e
+        finally:
+            # Keep consuming so a failed writer never blocks the feeder
+            for _ in tables:
+                pass
+
+    def put(self, table):
+        self.queue.put(table)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def is_up_to_date(filename, sources):
+    if not os.path.exists(filename):
+        return False
+    mtime = os.path.getmtime(filename)
+    # Missing sources cannot be newer, the snapshot is all there is
+    return all(os.path.getmtime(source) <= mtime
+               for source in sources if os.path.exists(source))
+
+
+def get_index(engine=None, geometry_backend='postgis',
+              length_cache=LENGTH_CACHE_FILENAME, index=None, postgis_options=None):
+    '''
+    Loads the index snapshot if it is newer than the source files and
+    was built with the same backend, otherwise builds the GeoIndex from
+    the GeoJSON files.
+    '''
     engine = engine or os.environ.get('DATABASE_URL')
-    idx = GeoIndex('geo/berlin_streets.geojson',
-                   'geo/polizeidirektionen.geojson',
-                   engine_config=engine,
-                   mapping=json.load(open('geo/missing_mapping.json')),
-                   district_history=json.load(open('geo/policedistrict_historic.json')))
-
+    geometry = get_geometry_backend(geometry_backend, engine_config=engine,
+                                    **(postgis_options or {}))
+    sources = [STREETS_FILENAME, DISTRICTS_FILENAME, MAPPING_FILENAME,
+               DISTRICT_HISTORY_FILENAME]
+    if index and is_up_to_date(index, sources):
+        with stats.timer('index.load_snapshot'):
+            snapshot = read_snapshot(index)
+        # Without the source files a mismatching snapshot still raises
+        if (snapshot['backend'] == geometry.name or
+                not all(os.path.exists(source) for source in sources)):
+            return GeoIndex.from_snapshot(index, geometry, snapshot)
+        print('%s was built with the %s backend, loading the GeoJSON files instead' %
+              (index, snapshot['backend']), file=sys.stderr)
+    if length_cache:
+        length_cache = LengthCache(length_cache)
+    return GeoIndex(STREETS_FILENAME,
+                    DISTRICTS_FILENAME,
+                    geometry=geometry,
+                    mapping=json.load(open(MAPPING_FILENAME)),
+                    district_history=json.load(open(DISTRICT_HISTORY_FILENAME)),
+                    length_cache=length_cache or None)
+
+
+def build_index(index=INDEX_FILENAME, lod_store=LOD_STORE_FILENAME, **kwargs):
+    idx = get_index(**kwargs)
+    write_snapshot(index, idx)
+    if lod_store:
+        idx.lod_store = LodStore(lod_store)
+        for zoom in LOD_ZOOMS:
+            idx.get_lod_shapes(zoom)
+
+
+def load_index(engine=None, geometry_backend='postgis', length_cache=LENGTH_CACHE_FILENAME,
+               index=INDEX_FILENAME, geocode_cache=GEOCODE_CACHE_FILENAME,
+               lod_store=LOD_STORE_FILENAME, postgis_options=None):
+    with stats.timer('index'):
+        idx = get_index(engine=engine, geometry_backend=geometry_backend,
+                        length_cache=length_cache, index=index,
+                        postgis_options=postgis_options)
+    if geocode_cache:
+        # Centers depend on the backend that computed the closest points
+        idx.geocode_cache = GeocodeCache(geocode_cache,
+                                         '%s:%s' % (idx.geometry.name, idx.version))
+    if lod_store:
+        idx.lod_store = LodStore(lod_store)
+    return idx
+
+
+def get_years(years):
     if not years:
-        years = list(range(2008, MAX_YEAR + 1))
-    else:
-        years = [int(y) for y in years.split(',')]
+        return list(range(2008, MAX_YEAR + 1))
+    return [int(y) for y in years.split(',')]
 
-    accident_generator = idx.get_accidents(years)
-    processor, format = GENERATORS[name]
-    processed = processor(idx, accident_generator)
-    OUTPUT_WRITER[format](sys.stdout, processed)
+
+def get_generator_options(window=3, end_year=MAX_YEAR):
+    return {
+        'time_compare': {'window': window, 'end_year': end_year}
+    }
+
+
+def main(names, years, engine=None, geometry_backend='postgis',
+         length_cache=LENGTH_CACHE_FILENAME, index=INDEX_FILENAME,
+         geocode_cache=GEOCODE_CACHE_FILENAME, lod_store=LOD_STORE_FILENAME,
+         output=None, jobs=1, lod=None,
+         precision=None, geojson_format='geojson', compress=None,
+         show_stats=False, trace=None, postgis_options=None,
+         async_concurrency=None, window=3, end_year=MAX_YEAR):
+    if show_stats or trace:
+        stats.enable(tracing=trace is not None)
+
+    if len(names) > 1 and output is None:
+        raise Exception('Several generators need an --output template')
+    per_year = output is not None and '{year}' in output
+    engine = engine or os.environ.get('DATABASE_URL')
+    if async_concurrency:
+        if geometry_backend != 'postgis':
+            raise Exception('--async-concurrency needs the postgis geometry backend')
+        if not engine:
+            raise Exception('--async-concurrency needs --engine or DATABASE_URL')
+
+    idx = load_index(engine=engine, geometry_backend=geometry_backend,
+                     length_cache=length_cache, index=index,
+                     geocode_cache=geocode_cache, lod_store=lod_store,
+                     postgis_options=postgis_options)
+    async_geometry = None
+    if async_concurrency:
+        async_geometry = AsyncPostGISGeometry(engine, concurrency=async_concurrency)
+
+    years = get_years(years)
+
+    output_options = {
+        'precision': precision,
+        'geojson_format': geojson_format,
+        'compress': compress,
+        'generator_options': get_generator_options(window, end_year),
+        'lod': lod
+    }
+
+    def get_path(name):
+        if output is None:
+            return None
+        return get_output_path(output, name, geojson_format=geojson_format)
+
+    # Over all years, streaming generators get each year as it is
+    # geocoded and only the others need all years buffered
+    streaming = []
+    buffered = names
+    if not per_year:
+        streaming = [name for name in names if name in STREAMING_GENERATORS]
+        buffered = [name for name in names if name not in STREAMING_GENERATORS]
+    streaming_outputs = None
+    all_accidents = []
+    all_lost_streets = Counter()
+    geocoded = geocode_years(idx, years, jobs=jobs, async_geometry=async_geometry)
+    try:
+        for year, accidents, lost_streets in geocoded:
+            if per_year:
+                idx.lost_streets = lost_streets
+                for name in names:
+                    path = get_output_path(output, name, year, geojson_format)
+                    write_output(idx, name, accidents, path=path, **output_options)
+                continue
+            if streaming_outputs is None:
+                # Started only now, after any geocoding processes were forked
+                streaming_outputs = [StreamingOutput(idx, name, get_path(name), **output_options)
+                                     for name in streaming]
+            for streaming_output in streaming_outputs:
+                streaming_output.put(accidents)
+            if buffered:
+                all_accidents.append(accidents)
+            all_lost_streets.update(lost_streets)
+    finally:
+        for streaming_output in streaming_outputs or []:
+            streaming_output.close()
+    if streaming_outputs is None:
+        # No years were geocoded
+        for name in streaming:
+            write_output(idx, name, [], path=get_path(name), **output_options)
+
+    if not per_year and buffered:
+        all_accidents = AccidentTable.concatenate(all_accidents)
+        idx.lost_streets = all_lost_streets
+        for name in buffered:
+            write_output(idx, name, all_accidents, path=get_path(name), **output_options)
+
+    if show_stats:
+        print(stats.format_summary(), file=sys.stderr)
+    if trace:
+        stats.write_trace(trace)
+
+
+def serve_main(years, host='127.0.0.1', port=8000, jobs=1, window=3,
+               end_year=MAX_YEAR, **index_options):
+    '''
+    Geocodes years once and serves queries against them until stopped.
+    '''
+    idx = load_index(**index_options)
+    tables = []
+    lost_streets = Counter()
+    for year, accidents, year_lost_streets in geocode_years(idx, get_years(years), jobs=jobs):
+        tables.append(accidents)
+        lost_streets.update(year_lost_streets)
+    idx.lost_streets = lost_streets
+    serve(idx, AccidentTable.concatenate(tables), GENERATORS, host=host, port=port,
+          generator_options=get_generator_options(window, end_year))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generate different output files from bike accident data.')
-    parser.add_argument('name', choices=list(GENERATORS.keys()))
+    parser.add_argument('name', nargs='+', choices=list(GENERATORS.keys()) + ['build-index', 'serve'],
+                        help='generators to run, build-index to write the index snapshot '
+                             'or serve to answer queries over HTTP')
     parser.add_argument('--engine', help='PostGIS engine URL')
     parser.add_argument('--years', help='years')
+    parser.add_argument('--geometry-backend', choices=list(BACKENDS.keys()),
+                        default='postgis',
+                        help='compute lengths and closest points locally or with PostGIS')
+    parser.add_argument('--pool-size', type=int, default=5,
+                        help='PostGIS connection pool size')
+    parser.add_argument('--postgis-feature-table', action='store_true',
+                        help='copy all streets into a temporary PostGIS table once '
+                             'and compute lengths and closest points by feature id')
+    parser.add_argument('--length-cache', default=LENGTH_CACHE_FILENAME,
+                        help='SQLite file caching street lengths across runs')
+    parser.add_argument('--no-length-cache', action='store_true',
+                        help='measure all street lengths again')
+    parser.add_argument('--geocode-cache', default=GEOCODE_CACHE_FILENAME,
+                        help='SQLite file caching geocoded rows across runs')
+    parser.add_argument('--no-geocode-cache', action='store_true',
+                        help='geocode all rows again')
+    parser.add_argument('--index', default=INDEX_FILENAME,
+                        help='prebuilt index snapshot, used if newer than the GeoJSON files')
+    parser.add_argument('--output',
+                        help='output path template with {name}, {format} and '
+                             'optionally {year} for one file per year, '
+                             'e.g. data/{name}_{year}.{format}')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of processes geocoding years in parallel')
+    parser.add_argument('--async-concurrency', type=int,
+                        help='query PostGIS with asyncpg, keeping up to this many '
+                             'closest point batches in flight')
+    parser.add_argument('--window', type=int, default=3,
+                        help='years per window compared by time_compare')
+    parser.add_argument('--end-year', type=int, default=MAX_YEAR,
+                        help='last year of the newer time_compare window')
+    parser.add_argument('--lod', type=int,
+                        help='write street geometries simplified for this web map zoom level')
+    parser.add_argument('--lod-store', default=LOD_STORE_FILENAME,
+                        help='SQLite file keeping simplified street geometries across runs')
+    parser.add_argument('--no-lod-store', action='store_true',
+                        help='simplify street geometries again')
+    parser.add_argument('--precision', type=int,
+                        help='round output coordinates to this many decimals')
+    parser.add_argument('--geojson-format', choices=GEOJSON_FORMATS, default='geojson',
+                        help='write geo outputs as FeatureCollection, newline-delimited '
+                             'features or binary WKB records')
+    parser.add_argument('--gzip', action='store_true', default=None,
+                        help='gzip the output (implied by output paths ending with .gz)')
+    parser.add_argument('--host', default='127.0.0.1', help='address to serve on')
+    parser.add_argument('--port', type=int, default=8000, help='port to serve on')
+    parser.add_argument('--stats', action='store_true',
+                        help='print timings, cache hits and lookup paths to stderr')
+    parser.add_argument('--trace',
+                        help='write timings and counters as Chrome trace JSON to this file')
 
     args = parser.parse_args()
-    main(args.name, args.years, engine=args.engine)
+    commands = [name for name in args.name if name in ('build-index', 'serve')]
+    if commands and len(args.name) > 1:
+        parser.error('%s cannot be combined with other names' % commands[0])
+    if args.window < 1:
+        parser.error('--window must be at least 1')
+    if args.async_concurrency and args.jobs != 1:
+        # Years are geocoded in this process while batches are in flight
+        parser.error('--jobs cannot be combined with --async-concurrency')
+    length_cache = None if args.no_length_cache else args.length_cache
+    lod_store = None if args.no_lod_store else args.lod_store
+    postgis_options = {
+        'pool_size': args.pool_size,
+        'feature_table': args.postgis_feature_table
+    }
+    if args.name == ['build-index']:
+        build_index(index=args.index, lod_store=lod_store, engine=args.engine,
+                    geometry_backend=args.geometry_backend,
+                    length_cache=length_cache, postgis_options=postgis_options)
+    elif args.name == ['serve']:
+        serve_main(args.years, host=args.host, port=args.port, jobs=args.jobs,
+                   window=args.window, end_year=args.end_year, engine=args.engine,
+                   geometry_backend=args.geometry_backend, length_cache=length_cache,
+                   index=args.index, lod_store=lod_store,
+                   geocode_cache=None if args.no_geocode_cache else args.geocode_cache,
+                   postgis_options=postgis_options)
+    else:
+        main(args.name, args.years, engine=args.engine,
+             geometry_backend=args.geometry_backend,
+             length_cache=length_cache, index=args.index,
+             geocode_cache=None if args.no_geocode_cache else args.geocode_cache,
+             lod_store=lod_store, output=args.output, jobs=args.jobs, lod=args.lod,
+             precision=args.precision,
+             geojson_format=args.geojson_format, compress=args.gzip,
+             show_stats=args.stats, trace=args.trace,
+             postgis_options=postgis_options,
+             async_concurrency=args.async_concurrency,
+             window=args.window, end_year=args.end_year)
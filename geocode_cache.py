@@ -0,0 +1,79 @@
+'''
+Persistent store of geocoded accident rows.
+
+Entries are keyed by the geometry backend and index version, the
+directorate and the normalized (already mapped) street names of a row
+and hold the matched feature indices, the center and the positions of
+streets that could not be found. Fixing a name in the mapping changes the key of the
+affected rows only, so a rerun geocodes just those.
+'''
+import json
+import os
+import sqlite3
+
+from shapely.geometry import Point
+
+
+class GeocodeCache(object):
+    def __init__(self, filename, version):
+        self.filename = filename
+        self.version = version
+        self._db = None
+        self._pid = None
+        self.entries = None
+
+    @property
+    def db(self):
+        # Forked worker processes open their own connection
+        if self._pid != os.getpid():
+            self._db = sqlite3.connect(self.filename, timeout=60)
+            self._db.execute('''CREATE TABLE IF NOT EXISTS geocodes (
+                version TEXT NOT NULL,
+                directorate TEXT NOT NULL,
+                streets TEXT NOT NULL,
+                feature_idx TEXT NOT NULL,
+                center_x REAL,
+                center_y REAL,
+                lost TEXT NOT NULL,
+                PRIMARY KEY (version, directorate, streets)
+            )''')
+            self._pid = os.getpid()
+        return self._db
+
+    def load(self):
+        self.entries = {}
+        rows = self.db.execute('''SELECT directorate, streets, feature_idx,
+            center_x, center_y, lost FROM geocodes WHERE version = ?''', (self.version,))
+        for directorate, streets, feature_idx, x, y, lost in rows:
+            center = None if x is None else Point(x, y)
+            self.entries[(directorate, streets)] = (
+                json.loads(feature_idx), center, json.loads(lost))
+
+    def get(self, directorate, names):
+        '''
+        Returns (feature_idx, center, lost positions) or None.
+        '''
+        if self.entries is None:
+            self.load()
+        return self.entries.get((directorate, json.dumps(names)))
+
+    def set_many(self, results):
+        '''
+        Stores (directorate, names, feature_idx, center, lost) tuples.
+        '''
+        rows = []
+        for directorate, names, feature_idx, center, lost in results:
+            key = (directorate, json.dumps(names))
+            if self.entries is not None:
+                self.entries[key] = (feature_idx, center, lost)
+            rows.append((
+                self.version, key[0], key[1], json.dumps(feature_idx),
+                None if center is None else center.x,
+                None if center is None else center.y,
+                json.dumps(lost)
+            ))
+        if rows:
+            with self.db:
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    rows)
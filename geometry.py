@@ -0,0 +1,111 @@
+'''
+Geometry backends for GeoIndex.
+
+Street lengths (on the WGS84 spheroid) and closest points between two
+shapes can either be computed locally with Shapely/pyproj or by a
+PostGIS server (see postgis.py).
+'''
+import hashlib
+import sqlite3
+
+from pyproj import Geod
+import shapely
+from shapely.geometry import Point
+from shapely.ops import nearest_points
+
+from postgis import PostGISGeometry
+from stats import stats
+
+
+class LocalGeometry(object):
+    name = 'local'
+
+    def __init__(self):
+        self.geod = Geod(ellps='WGS84')
+
+    def get_shape_length(self, shape):
+        with stats.timer('local.length'):
+            return self.geod.geometry_length(shape)
+
+    def get_shape_lengths(self, shapes):
+        return [self.get_shape_length(s) for s in shapes]
+
+    def get_feature_lengths(self, shapes, ids):
+        return [self.get_shape_length(shapes[i]) for i in ids]
+
+    def dispose(self):
+        pass
+
+    def get_closest_points(self, a, b):
+        with stats.timer('local.closest_points'):
+            return nearest_points(a, b)
+
+    def get_closest_points_many(self, pairs, shapes):
+        '''
+        Closest points for (a, b) index pairs into shapes, where b None
+        stands for the centroid of a.
+        '''
+        if not pairs:
+            return []
+        a = [shapes[i] for i, _ in pairs]
+        b = [shapes[i].centroid if j is None else shapes[j] for i, j in pairs]
+        stats.incr('local.closest_points_many.pairs', len(pairs))
+        with stats.timer('local.closest_points_many'):
+            lines = shapely.shortest_line(a, b)
+        coords = shapely.get_coordinates(lines).reshape(-1, 2, 2)
+        return [(Point(c[0]), Point(c[1])) for c in coords]
+
+
+def get_geometry_hash(shape):
+    return hashlib.sha1(shape.wkb).digest()
+
+
+class LengthCache(object):
+    '''
+    Persistent store of street lengths in an SQLite file, keyed by
+    the hash of the feature geometry and the backend that measured it.
+    Changed geometries get a new hash and are measured again.
+    '''
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS lengths (
+            geom_hash BLOB NOT NULL,
+            backend TEXT NOT NULL,
+            length REAL,
+            PRIMARY KEY (geom_hash, backend)
+        )''')
+
+    def get_shape_lengths(self, shapes, geometry):
+        cached = dict(self.db.execute(
+            'SELECT geom_hash, length FROM lengths WHERE backend = ?',
+            (geometry.name,)))
+        hashes = [get_geometry_hash(s) for s in shapes]
+        missing = {}
+        for i, geom_hash in enumerate(hashes):
+            if geom_hash not in cached:
+                missing.setdefault(geom_hash, i)
+        stats.incr('length_cache.hit', len(hashes) - len(missing))
+        stats.incr('length_cache.miss', len(missing))
+        new_lengths = dict(zip(missing, geometry.get_feature_lengths(
+            shapes, list(missing.values()))))
+        lengths = [cached[h] if h in cached else new_lengths[h] for h in hashes]
+        if new_lengths:
+            with self.db:
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO lengths VALUES (?, ?, ?)',
+                    [(h, geometry.name, length) for h, length in new_lengths.items()])
+        return lengths
+
+
+BACKENDS = {
+    'local': LocalGeometry,
+    'postgis': PostGISGeometry,
+}
+
+
+def get_geometry_backend(name, engine_config=None, **options):
+    if name == 'postgis':
+        if not engine_config:
+            raise Exception('PostGIS geometry backend needs an engine URL')
+        return PostGISGeometry(engine_config, **options)
+    return BACKENDS[name]()
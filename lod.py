@@ -0,0 +1,68 @@
+'''
+Levels of detail for street geometries.
+
+Street shapes are simplified per web map zoom level with a tolerance of
+half a pixel, preserving the topology of every feature. An LodStore
+keeps the simplified levels in an SQLite file keyed by the index
+version, so every level is computed once per streets file.
+'''
+import sqlite3
+import threading
+
+import numpy
+import shapely
+
+from stats import stats
+
+
+# Levels precomputed by build-index
+LOD_ZOOMS = range(10, 17)
+
+
+def get_tolerance(zoom):
+    # Half a pixel of a 256 pixel tile, in degrees
+    return 360 / (256 * 2 ** zoom) / 2
+
+
+def simplify_shapes(shapes, zoom):
+    with stats.timer('lod.simplify'):
+        return shapely.simplify(numpy.array(list(shapes), dtype=object),
+                                get_tolerance(zoom), preserve_topology=True)
+
+
+class LodStore(object):
+    def __init__(self, filename):
+        # Levels are also requested from writer and server threads
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute('''CREATE TABLE IF NOT EXISTS lods (
+            version TEXT NOT NULL,
+            zoom INTEGER NOT NULL,
+            feature INTEGER NOT NULL,
+            wkb BLOB NOT NULL,
+            PRIMARY KEY (version, zoom, feature)
+        )''')
+
+    def get_shapes(self, version, zoom, shapes):
+        '''
+        Shapes simplified for zoom, computed and stored if the level
+        is not in the store yet.
+        '''
+        with self.lock:
+            return self._get_shapes(version, zoom, shapes)
+
+    def _get_shapes(self, version, zoom, shapes):
+        rows = self.db.execute(
+            'SELECT wkb FROM lods WHERE version = ? AND zoom = ? ORDER BY feature',
+            (version, zoom)).fetchall()
+        if rows and len(rows) == len(shapes):
+            stats.incr('lod_store.hit')
+            return shapely.from_wkb([row[0] for row in rows])
+        stats.incr('lod_store.miss')
+        simplified = simplify_shapes(shapes, zoom)
+        with self.db:
+            self.db.execute('DELETE FROM lods WHERE version = ? AND zoom = ?', (version, zoom))
+            self.db.executemany(
+                'INSERT INTO lods VALUES (?, ?, ?, ?)',
+                [(version, zoom, i, wkb) for i, wkb in enumerate(shapely.to_wkb(simplified))])
+        return simplified
@@ -0,0 +1,93 @@
+'''
+Trigram index over normalized street names for matching lost streets.
+
+Names are split into trigrams padded at the start only, so a name cut
+off in the PDF ("schulzendorf") shares all its trigrams with the full
+name ("schulzendorferstr"). A query counts the shared trigrams of all
+names at once, keeps the few names that can be within the edit distance
+bound and ranks them by their edit distance to the query or a prefix.
+'''
+from collections import defaultdict
+
+import numpy
+
+
+PAD = '  '
+MAX_DISTANCE = 2
+MAX_CANDIDATES = 10
+
+
+def get_trigrams(name):
+    padded = PAD + name
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def get_prefix_distance(query, name, max_distance):
+    '''
+    Smallest edit distance between query and name or a prefix of name
+    as (distance, prefix length), or None if it exceeds max_distance.
+    Only cells within max_distance of the diagonal are computed.
+    '''
+    n = len(name)
+    if len(query) > n + max_distance:
+        return None
+    over = max_distance + 1
+    previous = [j if j <= max_distance else over for j in range(n + 1)]
+    for i, char in enumerate(query, start=1):
+        low, high = max(1, i - max_distance), min(n, i + max_distance)
+        current = [over] * (n + 1)
+        current[0] = min(i, over)
+        for j in range(low, high + 1):
+            current[j] = min(previous[j - 1] + (char != name[j - 1]),
+                             previous[j] + 1, current[j - 1] + 1, over)
+        if min(current[low - 1:high + 1]) > max_distance:
+            return None
+        previous = current
+    distance = min(previous)
+    if distance > max_distance:
+        return None
+    # Longest prefix with the smallest distance
+    return distance, n - previous[::-1].index(distance)
+
+
+class TrigramIndex(object):
+    def __init__(self, names):
+        self.names = list(names)
+        postings = defaultdict(list)
+        for i, name in enumerate(self.names):
+            for gram in get_trigrams(name):
+                postings[gram].append(i)
+        self.postings = {gram: numpy.array(ids, dtype=numpy.int32)
+                         for gram, ids in postings.items()}
+
+    def search(self, query, max_distance=MAX_DISTANCE, limit=1):
+        '''
+        Returns up to limit (name, confidence, distance) tuples, best
+        first. The distance bound shrinks to a quarter of the query
+        length for short queries. Confidence is 1 for an exact match and
+        drops with the edit distance and the part of the name left over
+        after a matched prefix.
+        '''
+        max_distance = min(max_distance, len(query) // 4)
+        grams = get_trigrams(query)
+        postings = [self.postings[gram] for gram in grams if gram in self.postings]
+        if not postings:
+            return []
+        shared = numpy.bincount(numpy.concatenate(postings), minlength=len(self.names))
+        # Every edit changes at most three trigrams
+        threshold = max(1, len(grams) - 3 * max_distance)
+        candidates = numpy.flatnonzero(shared >= threshold)
+        if len(candidates) > MAX_CANDIDATES:
+            best = numpy.argsort(-shared[candidates], kind='stable')[:MAX_CANDIDATES]
+            candidates = candidates[best]
+        results = []
+        for i in candidates.tolist():
+            name = self.names[i]
+            match = get_prefix_distance(query, name, max_distance)
+            if match is None:
+                continue
+            distance, length = match
+            confidence = (1 - distance / len(query)) * (0.5 + 0.5 * length / len(name))
+            results.append((name, confidence, distance))
+        results.sort(key=lambda result: -result[1])
+        return results[:limit]
@@ -1,99 +1,230 @@
+import argparse
 import csv
+from functools import partial
+import multiprocessing
+import os
 import sys
 import re
 
 
-STREET_RE = re.compile('^([A-Z\dÖÄÜß\-\(]{2,}|\s*/\s*)[^a-z]+[A-ZÖÄÜß-]{2}[^a-z]*$')
-SHORT_STREET_RE = re.compile('^[^a-z]+$')
-NUM_RE = re.compile('^\s*(\d+)\s*')
+# Classifies a street cell in one match: None if it contains lower case
+# letters, a match with the street group set if it starts a street name
+# and one without if it can only continue a street name
+CELL_RE = re.compile(r'(?P<street>(?:[A-Z\dÖÄÜß\-\(]{2}|\s*/)[^a-z]+?[A-ZÖÄÜß-]{2})?[^a-z]*\Z')
+NUM_RE = re.compile(r'^\s*(\d+)\s*')
 LONG_LINE_LENGTH = 35
 DEFAULT_VALUE = 1
 
-MULTI_SPACE_RE = re.compile('\s{2,}')
+MULTI_SPACE_RE = re.compile(r'\s{2,}')
+
+FILENAME_RE = re.compile(r'(\d{4})_raw\.csv$')
+FIELDNAMES = ('year', 'directorate', 'street', 'count')
+
+# Parser states: no street, street cells collected, street with count
+# waiting for a last continuation cell
+EMPTY, STREET, COUNTED = range(3)
 
 
 def clean(val):
-    return MULTI_SPACE_RE.sub(' ', val.strip())
+    val = val.strip()
+    # Printable strings have no whitespace but single spaces
+    if '  ' not in val and val.isprintable():
+        return val
+    return MULTI_SPACE_RE.sub(' ', val)
+
+
+def get_number(val):
+    '''
+    Leading number of a cell or None.
+    '''
+    if val.isdecimal():
+        return int(val)
+    is_num = NUM_RE.match(val)
+    if is_num is None:
+        return None
+    return int(is_num.group(1))
 
 
 def parse_lines(reader):
+    '''
+    Yields (street, count, directorate) from Tabula rows. Street names
+    can continue over several rows; their cells are collected in parts
+    and joined once the street is complete. Streets seen before the
+    first directorate number are held back until it appears.
+    '''
     back_log = []
-    current = None
+    state = EMPTY
+    parts = []
+    # Length of the street joined from parts
+    length = 0
+    # Count and directorate of a COUNTED street
+    counted = None
     directorate = None
     for lineno, line in enumerate(reader, start=1):
-        is_num = False
         if line[0]:
-            is_num = NUM_RE.match(line[0])
-            if is_num is not None:
-                direct_val = int(is_num.group(1).strip())
-                if 0 < direct_val < 70 and (directorate is None or
-                                            direct_val > directorate):
-                    directorate = direct_val
-                    if back_log:
-                        for a, b, _ in back_log:
-                            yield a, b, directorate
-                        back_log = []
-                    if isinstance(current, tuple) and current[2] is None:
-                        yield current[0], current[1], directorate
-                        current = None
-        if line[0] and not is_num:
-            continue
+            direct_val = get_number(line[0])
+            if direct_val is None:
+                continue
+            if 0 < direct_val < 70 and (directorate is None or
+                                        direct_val > directorate):
+                directorate = direct_val
+                if back_log:
+                    for a, b, _ in back_log:
+                        yield a, b, directorate
+                    back_log = []
+                if state == COUNTED and counted[1] is None:
+                    yield ' '.join(parts), counted[0], directorate
+                    state = EMPTY
 
         cell = line[2].lstrip()
-        is_street = False
         if cell:
-            if current is not None and (isinstance(current, tuple) or
-                                        len(current) > LONG_LINE_LENGTH):
-                is_street = SHORT_STREET_RE.match(cell)
+            match = CELL_RE.match(cell)
+            if state == COUNTED or (state == STREET and length > LONG_LINE_LENGTH):
+                is_street = match is not None
             else:
-                is_street = STREET_RE.match(cell)
-            if is_street is None and current is not None:
+                is_street = match is not None and match.group('street') is not None
+            if not is_street:
+                if state == EMPTY:
+                    continue
+                current = ' '.join(parts)
+                if state == COUNTED:
+                    current = (current,) + counted
                 if cell.startswith('in der Direktion'):
                     yield current, DEFAULT_VALUE, directorate
-                    current = None
+                    state = EMPTY
                     continue
-                else:
-                    raise ValueError('%s: %s (%s)' % (lineno, line, current))
-            if is_street is None:
-                continue
-            if current is not None:
-                yield_now = None
-                if isinstance(current, tuple):
-                    yield_now = current
-                    current = current[0]
-                current = current + ' ' + is_street.group(0)
-                if yield_now:
+                raise ValueError('%s: %s (%s)' % (lineno, line, current))
+            if state == EMPTY:
+                parts = [cell]
+                length = len(cell)
+                state = STREET
+            else:
+                parts.append(cell)
+                length += 1 + len(cell)
+                if state == COUNTED:
                     if directorate is None:
-                        back_log.append((clean(current), yield_now[1], yield_now[2]))
+                        back_log.append((clean(' '.join(parts)),) + counted)
                     else:
-                        yield clean(current), yield_now[1], yield_now[2]
-                    current = None
+                        yield (clean(' '.join(parts)),) + counted
+                    state = EMPTY
                     continue
-            else:
-                current = is_street.group(0)
 
-        num_cell = line[3]
-        is_count = NUM_RE.match(num_cell)
-        if is_count is not None and current:
-            if not cell and current:
-                current = current, int(is_count.group(0).strip()), directorate
-            else:
+        count = get_number(line[3]) if line[3] else None
+        if count is not None and state != EMPTY:
+            if cell:
                 if directorate is None:
-                    back_log.append((clean(current), int(is_count.group(0).strip()), directorate))
+                    back_log.append((clean(' '.join(parts)), count, directorate))
                 else:
-                    yield clean(current), int(is_count.group(0).strip()), directorate
-                current = None
+                    yield clean(' '.join(parts)), count, directorate
+                state = EMPTY
+            elif state == STREET:
+                counted = (count, directorate)
+                state = COUNTED
+            else:
+                raise ValueError('%s: %s (second count for %s)' % (lineno, line, ' '.join(parts)))
 
-        if cell and not is_count and is_street and not current:
-            raise ValueError('%s: %s (%s)' % (lineno, line, current))
+
+def get_year(filename):
+    match = FILENAME_RE.search(os.path.basename(filename))
+    if match is None:
+        raise ValueError('No year in file name %s' % filename)
+    return match.group(1)
+
+
+def write_rows(fh, year, items, header=True):
+    writer = csv.DictWriter(fh, FIELDNAMES)
+    if header:
+        writer.writeheader()
+    count = 0
+    for item in items:
+        writer.writerow({'year': year, 'directorate': item[2], 'street': item[0], 'count': item[1]})
+        count += 1
+    return count
+
+
+def parse_file(filename, output=None):
+    '''
+    Parses a {year}_raw.csv file and writes it to the output template
+    with {year} or, without output, returns its rows. Returns
+    (filename, year, rows or row count, error message).
+    '''
+    year = get_year(filename)
+    path = None
+    try:
+        with open(filename) as f:
+            reader = csv.reader(f)
+            if output is None:
+                return filename, year, list(parse_lines(reader)), None
+            path = output.format(year=year)
+            dirname = os.path.dirname(path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            # Written under a temporary name, so failed files leave no output
+            with open(path + '.tmp', 'w', newline='') as out:
+                count = write_rows(out, year, parse_lines(reader))
+            os.replace(path + '.tmp', path)
+            return filename, year, count, None
+    except (ValueError, IndexError, OSError) as e:
+        if path is not None and os.path.exists(path + '.tmp'):
+            os.remove(path + '.tmp')
+        if isinstance(e, IndexError):
+            return filename, year, None, 'Row with too few columns'
+        return filename, year, None, str(e)
+
+
+def parse_files(filenames, output=None, jobs=None):
+    '''
+    Yields parse_file results in the order of filenames, parsing files
+    in a pool of jobs processes.
+    '''
+    parse = partial(parse_file, output=output)
+    if jobs == 1 or len(filenames) == 1:
+        yield from map(parse, filenames)
+        return
+    with multiprocessing.Pool(jobs) as pool:
+        yield from pool.imap(parse, filenames)
 
 
 def main():
-    reader = csv.reader(sys.stdin)
-    writer = csv.DictWriter(sys.stdout, ('year', 'directorate', 'street', 'count'))
-    writer.writeheader()
-    for item in parse_lines(reader):
-        writer.writerow({'year': sys.argv[1], 'directorate': item[2], 'street': item[0], 'count': item[1]})
+    parser = argparse.ArgumentParser(description='Parse Tabula CSVs of accident reports.')
+    parser.add_argument('inputs', nargs='+',
+                        help='{year}_raw.csv files, or a single year to parse stdin to stdout')
+    parser.add_argument('--output',
+                        help='output path template with {year} for one file per year, '
+                             'e.g. csvs/{year}.csv, or one file for all years '
+                             '(defaults to stdout)')
+    parser.add_argument('--jobs', type=int,
+                        help='number of processes parsing files (defaults to all cores)')
+    args = parser.parse_args()
+
+    if len(args.inputs) == 1 and args.inputs[0].isdigit():
+        write_rows(sys.stdout, args.inputs[0], parse_lines(csv.reader(sys.stdin)))
+        return
+
+    for filename in args.inputs:
+        if FILENAME_RE.search(os.path.basename(filename)) is None:
+            parser.error('No year in file name %s' % filename)
+
+    per_year = args.output is not None and '{year}' in args.output
+    combined = None
+    if not per_year:
+        combined = sys.stdout if args.output is None else open(args.output, 'w', newline='')
+
+    failed = 0
+    header = True
+    results = parse_files(args.inputs, output=args.output if per_year else None, jobs=args.jobs)
+    for filename, year, rows, error in results:
+        if error is not None:
+            failed += 1
+            print('%s: %s' % (filename, error), file=sys.stderr)
+            continue
+        if combined is not None:
+            write_rows(combined, year, rows, header=header)
+            header = False
+    if combined is not None and combined is not sys.stdout:
+        combined.close()
+    if failed:
+        sys.exit('%d of %d files failed' % (failed, len(args.inputs)))
 
 
 if __name__ == '__main__':
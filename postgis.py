@@ -0,0 +1,273 @@
+'''
+PostGIS geometry backend.
+
+Queries are server-side prepared statements with bound parameters;
+geometries travel as WKB in bytea arrays, so one statement measures or
+compares a whole batch. Connections come from a configured SQLAlchemy
+pool and get the statements prepared when they are opened.
+
+With feature_table=True all street shapes are loaded once into a
+temporary table with COPY and lengths and closest points are computed
+by joining on feature ids instead of sending geometries again.
+
+AsyncPostGISGeometry runs the same closest point statements over an
+asyncpg pool so that many batches are in flight at once.
+'''
+import asyncio
+import io
+import re
+
+import shapely
+from shapely import wkb
+from sqlalchemy import create_engine, event
+
+from stats import stats
+
+
+BATCH_SIZE = 2000
+
+STATEMENTS = {
+    'shape_lengths': ('bytea[]', '''
+        SELECT ST_Length(ST_GeomFromWKB(foo.g, 4326)::geography)
+        FROM unnest($1) WITH ORDINALITY AS foo(g, i)
+        ORDER BY foo.i'''),
+    'closest_points': ('bytea[], bytea[]', '''
+        SELECT ST_AsBinary(ST_ClosestPoint(foo.a, foo.b)),
+               ST_AsBinary(ST_ClosestPoint(foo.b, foo.a))
+        FROM (
+            SELECT ST_GeomFromWKB(wa) AS a, ST_GeomFromWKB(wb) AS b, i
+            FROM unnest($1, $2) WITH ORDINALITY AS pairs(wa, wb, i)
+        ) AS foo
+        ORDER BY foo.i'''),
+}
+
+FEATURE_STATEMENTS = {
+    'feature_shape_lengths': ('integer[]', '''
+        SELECT ST_Length(ST_SetSRID(f.geom, 4326)::geography)
+        FROM unnest($1) WITH ORDINALITY AS ids(id, i)
+        JOIN pg_temp.features f ON f.id = ids.id
+        ORDER BY ids.i'''),
+    'feature_closest_points': ('integer[], integer[]', '''
+        SELECT ST_AsBinary(ST_ClosestPoint(foo.a, foo.b)),
+               ST_AsBinary(ST_ClosestPoint(foo.b, foo.a))
+        FROM (
+            SELECT a.geom AS a, COALESCE(b.geom, ST_Centroid(a.geom)) AS b, pairs.i
+            FROM unnest($1, $2) WITH ORDINALITY AS pairs(a_id, b_id, i)
+            JOIN pg_temp.features a ON a.id = pairs.a_id
+            LEFT JOIN pg_temp.features b ON b.id = pairs.b_id
+        ) AS foo
+        ORDER BY foo.i'''),
+}
+
+
+def prepare(cursor, statements):
+    for name, (types, query) in statements.items():
+        cursor.execute('PREPARE %s (%s) AS %s' % (name, types, query))
+
+
+def execute(cursor, name, *params):
+    # Explicit casts, as an array of only NULLs would be typed text[]
+    types, _ = STATEMENTS.get(name) or FEATURE_STATEMENTS[name]
+    casts = ', '.join('%%s::%s' % t for t in types.split(', '))
+    cursor.execute('EXECUTE %s (%s)' % (name, casts), params)
+    return cursor.fetchall()
+
+
+def get_typed_query(name):
+    '''
+    Statement with explicit parameter casts, as asyncpg prepares
+    statements without declared parameter types.
+    '''
+    types, query = STATEMENTS[name]
+    for i, t in enumerate(types.split(', '), start=1):
+        query = query.replace('$%d' % i, '$%d::%s' % (i, t))
+    return query
+
+
+def get_dsn(engine_config):
+    # asyncpg takes a plain postgresql:// URL without SQLAlchemy driver
+    return re.sub(r'^postgres(ql)?\+\w+://', 'postgresql://', engine_config)
+
+
+def batches(items, size=BATCH_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class PostGISGeometry(object):
+    name = 'postgis'
+
+    def __init__(self, engine_config, pool_size=5, feature_table=False):
+        self.engine_config = engine_config
+        self.pool_size = pool_size
+        self.engine = self.make_engine()
+        self.feature_table = feature_table
+        # Connection that holds the temporary feature table
+        self.feature_connection = None
+        # Engine and connection inherited by a forked process
+        self.inherited = None
+
+    def make_engine(self):
+        engine = create_engine(self.engine_config, pool_size=self.pool_size,
+                               max_overflow=0, pool_recycle=3600)
+        event.listen(engine, 'connect', self.on_connect)
+        return engine
+
+    def on_connect(self, dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        prepare(cursor, STATEMENTS)
+        cursor.close()
+        dbapi_connection.commit()
+
+    def dispose(self):
+        '''
+        Gives a forked process its own pool. The inherited connections
+        share their sockets with the parent, and closing them would end
+        the parent's sessions, so they stay referenced and unused.
+        '''
+        self.inherited = (self.engine, self.feature_connection)
+        self.feature_connection = None
+        self.engine = self.make_engine()
+
+    def query(self, name, *params):
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            with stats.timer('postgis.%s' % name):
+                rows = execute(cursor, name, *params)
+            cursor.close()
+        finally:
+            connection.close()
+        return rows
+
+    def get_shape_length(self, shape):
+        return self.get_shape_lengths([shape])[0]
+
+    def get_shape_lengths(self, shapes):
+        lengths = []
+        for batch in batches(list(shapes)):
+            rows = self.query('shape_lengths', [s.wkb for s in batch])
+            lengths.extend(row[0] for row in rows)
+        return lengths
+
+    def get_feature_lengths(self, shapes, ids):
+        '''
+        Lengths of the shapes at the given indices.
+        '''
+        if not self.feature_table:
+            return self.get_shape_lengths([shapes[i] for i in ids])
+        if self.feature_connection is None:
+            self.load_features(shapes)
+        cursor = self.feature_connection.cursor()
+        lengths = []
+        for batch in batches(list(ids)):
+            with stats.timer('postgis.feature_shape_lengths'):
+                rows = execute(cursor, 'feature_shape_lengths', batch)
+            lengths.extend(row[0] for row in rows)
+        cursor.close()
+        return lengths
+
+    def get_closest_points(self, a, b):
+        rows = self.query('closest_points', [a.wkb], [b.wkb])
+        return wkb.loads(bytes(rows[0][0])), wkb.loads(bytes(rows[0][1]))
+
+    def load_features(self, shapes):
+        '''
+        Copies all shapes into a temporary table on a dedicated
+        connection, keyed by their index.
+        '''
+        # Detached from the pool, so the table stays with this connection
+        pooled = self.engine.connect()
+        pooled.detach()
+        connection = pooled.connection
+        cursor = connection.cursor()
+        cursor.execute('''CREATE TEMPORARY TABLE features (
+            id integer PRIMARY KEY,
+            geom geometry NOT NULL
+        )''')
+        data = io.StringIO()
+        for i, s in enumerate(shapes):
+            data.write('%d\t%s\n' % (i, shapely.to_wkb(s, hex=True)))
+        data.seek(0)
+        with stats.timer('postgis.copy_features'):
+            cursor.copy_expert('COPY features (id, geom) FROM STDIN', data)
+        cursor.execute('ANALYZE features')
+        prepare(cursor, FEATURE_STATEMENTS)
+        cursor.close()
+        connection.commit()
+        self.feature_connection = connection
+
+    def get_closest_points_many(self, pairs, shapes):
+        '''
+        Closest points for (a, b) index pairs into shapes, where b None
+        stands for the centroid of a.
+        '''
+        if self.feature_table:
+            return self.get_feature_closest_points_many(pairs, shapes)
+        results = []
+        for batch in batches(pairs):
+            a = [shapes[i].wkb for i, _ in batch]
+            b = [(shapes[i].centroid if j is None else shapes[j]).wkb for i, j in batch]
+            stats.incr('postgis.closest_points.pairs', len(batch))
+            rows = self.query('closest_points', a, b)
+            results.extend((wkb.loads(bytes(a_b)), wkb.loads(bytes(b_a))) for a_b, b_a in rows)
+        return results
+
+    def get_feature_closest_points_many(self, pairs, shapes):
+        if self.feature_connection is None:
+            self.load_features(shapes)
+        cursor = self.feature_connection.cursor()
+        results = []
+        for batch in batches(pairs):
+            stats.incr('postgis.feature_closest_points.pairs', len(batch))
+            with stats.timer('postgis.feature_closest_points'):
+                rows = execute(cursor, 'feature_closest_points',
+                               [i for i, _ in batch], [j for _, j in batch])
+            results.extend((wkb.loads(bytes(a_b)), wkb.loads(bytes(b_a))) for a_b, b_a in rows)
+        cursor.close()
+        return results
+
+
+class AsyncPostGISGeometry(object):
+    '''
+    Closest points over an asyncpg pool. At most concurrency batches
+    of batch_size pairs are queried at the same time; results keep the
+    order of the pairs.
+    '''
+    name = 'postgis'
+
+    def __init__(self, engine_config, concurrency=10, batch_size=200):
+        self.dsn = get_dsn(engine_config)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.pool = None
+
+    async def connect(self):
+        import asyncpg
+
+        self.pool = await asyncpg.create_pool(self.dsn, min_size=1,
+                                              max_size=self.concurrency)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def query(self, name, *params):
+        # Waits for a free pool connection, which bounds the concurrency
+        async with self.pool.acquire() as connection:
+            stats.incr('postgis.async.%s' % name)
+            return await connection.fetch(get_typed_query(name), *params)
+
+    async def get_closest_points_many(self, pairs, shapes):
+        tasks = []
+        for batch in batches(pairs, self.batch_size):
+            a = [shapes[i].wkb for i, _ in batch]
+            b = [(shapes[i].centroid if j is None else shapes[j]).wkb for i, j in batch]
+            stats.incr('postgis.closest_points.pairs', len(batch))
+            tasks.append(self.query('closest_points', a, b))
+        with stats.timer('postgis.async.closest_points_many'):
+            # gather returns results in task order
+            batch_rows = await asyncio.gather(*tasks)
+        return [(wkb.loads(bytes(a_b)), wkb.loads(bytes(b_a)))
+                for rows in batch_rows for a_b, b_a in rows]
@@ -1,6 +1,3 @@
 set -ex
 
-for num in `seq 2003 2016`
-do
-    python parser.py "$num" < "csvs/${num}_raw.csv" > "csvs/${num}.csv"
-done
+python parser.py --output 'csvs/{year}.csv' `for num in $(seq 2003 2016); do echo "csvs/${num}_raw.csv"; done`
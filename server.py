@@ -0,0 +1,244 @@
+'''
+HTTP query service over a warm index and accident table.
+
+python generate.py serve --years 2015,2016,2017 --port 8000
+
+keeps the GeoIndex and the AccidentTable of the geocoded years in memory
+and answers
+
+/<generator>?year=2017&directorate=11&street=...&bbox=west,south,east,north
+    output of a generator over the matching accidents, geo outputs with
+    format=geojson|ndjson|wkb, precision=N and lod=<zoom level>
+/tiles/<accident_streets|time_compare>/<z>/<x>/<y>.geojson
+    GeoJSON tile of the generator's streets, simplified for the zoom
+    level and clipped to the tile
+
+Responses are kept in an LRU cache keyed by the request path and
+limited by the total size of their bodies.
+'''
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import math
+import sys
+import threading
+from urllib.parse import parse_qsl, urlsplit, urlencode
+
+import numpy
+import shapely
+from shapely.geometry import box, mapping
+from shapely.strtree import STRtree
+
+from stats import stats
+from writers import BINARY_FORMATS, GEOJSON_FORMATS, OUTPUT_WRITER, write_geojson
+
+
+# Total bytes of cached response bodies
+CACHE_BYTES = 64 * 1024 * 1024
+MAX_ZOOM = 20
+MAX_PRECISION = 15
+TILE_LAYERS = ('accident_streets', 'time_compare')
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'geojson': 'application/geo+json',
+    'ndjson': 'application/x-ndjson',
+    'wkb': 'application/octet-stream',
+}
+
+
+def get_tile_bounds(z, x, y):
+    '''
+    (west, south, east, north) in degrees of a web mercator tile.
+    '''
+    n = 2 ** z
+    west = x / n * 360 - 180
+    east = (x + 1) / n * 360 - 180
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return west, south, east, north
+
+
+def get_bounded(query, key, maximum):
+    # Every value builds and caches geometries, so only a few are allowed
+    if key not in query:
+        return None
+    value = int(query[key])
+    if not 0 <= value <= maximum:
+        raise ValueError('%s must be between 0 and %d' % (key, maximum))
+    return value
+
+
+def filter_accidents(accidents, query):
+    mask = numpy.ones(len(accidents), dtype=bool)
+    if 'year' in query:
+        years = [int(y) for y in query['year'].split(',')]
+        mask &= numpy.isin(accidents.year, years)
+    if 'directorate' in query:
+        wanted = set(query['directorate'].split(','))
+        codes = [i for i, d in enumerate(accidents.directorates) if d in wanted]
+        mask &= numpy.isin(accidents.directorate, codes)
+    if 'street' in query:
+        street = query['street'].upper()
+        codes = [i for i, s in enumerate(accidents.streets) if street in s.upper()]
+        mask &= numpy.isin(accidents.street, codes)
+    if 'bbox' in query:
+        west, south, east, north = [float(v) for v in query['bbox'].split(',')]
+        # Rows without center are NaN and never inside
+        with numpy.errstate(invalid='ignore'):
+            mask &= ((accidents.center_x >= west) & (accidents.center_x <= east) &
+                     (accidents.center_y >= south) & (accidents.center_y <= north))
+    return accidents.select(mask)
+
+
+class TileLayer(object):
+    '''
+    Street features of an aggregating generator, drawn from the index's
+    level of detail for the zoom of a tile.
+    '''
+    def __init__(self, idx, features):
+        self.idx = idx
+        self.properties = [f['properties'] for f in features]
+        self.feature_ids = numpy.array([f['geometry_id'] for f in features], dtype=numpy.int64)
+        self.tree = STRtree([idx.shapes[i] for i in self.feature_ids.tolist()])
+
+    def get_features(self, z, x, y):
+        bounds = get_tile_bounds(z, x, y)
+        hits = self.tree.query(box(*bounds))
+        hits.sort()
+        shapes = self.idx.get_lod_shapes(z)[self.feature_ids[hits]]
+        clipped = shapely.clip_by_rect(shapes, *bounds)
+        for i, geom in zip(hits.tolist(), clipped):
+            if geom.is_empty:
+                continue
+            yield {
+                'type': 'Feature',
+                'properties': self.properties[i],
+                'geometry': mapping(geom)
+            }
+
+
+class QueryServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, idx, accidents, generators,
+                 generator_options=None, cache_bytes=CACHE_BYTES):
+        super().__init__(address, QueryHandler)
+        self.idx = idx
+        self.accidents = accidents
+        self.generators = generators
+        self.generator_options = generator_options or {}
+        self.cache_bytes = cache_bytes
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        self.tile_layers = {}
+        # Building a layer only blocks requests for the same layer
+        self.tile_layer_locks = {name: threading.Lock() for name in TILE_LAYERS}
+        self.lock = threading.Lock()
+
+    def get_response(self, path):
+        '''
+        Returns (status, content type, body) for a request path.
+        '''
+        parts = urlsplit(path)
+        query = dict(parse_qsl(parts.query))
+        key = '%s?%s' % (parts.path, urlencode(sorted(query.items())))
+        with self.lock:
+            if key in self.cache:
+                stats.incr('serve.cache.hit')
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        stats.incr('serve.cache.miss')
+        try:
+            with stats.timer('serve.request'):
+                response = self.render(parts.path.strip('/').split('/'), query)
+        except (KeyError, ValueError) as e:
+            return 400, 'text/plain; charset=utf-8', ('%s\n' % e).encode('utf-8')
+        if response[0] == 200:
+            self.add_to_cache(key, response)
+        return response
+
+    def add_to_cache(self, key, response):
+        size = len(response[2])
+        # Keeps a few large responses from taking the whole cache
+        if size > self.cache_bytes // 4:
+            return
+        with self.lock:
+            if key in self.cache:
+                return
+            self.cache[key] = response
+            self.cached_bytes += size
+            while self.cached_bytes > self.cache_bytes:
+                _, evicted = self.cache.popitem(last=False)
+                self.cached_bytes -= len(evicted[2])
+
+    def render(self, path, query):
+        if len(path) == 1 and path[0] in self.generators:
+            return self.render_generator(path[0], query)
+        if len(path) == 5 and path[0] == 'tiles' and path[1] in TILE_LAYERS:
+            z, x = int(path[2]), int(path[3])
+            y = int(path[4].split('.')[0])
+            if not 0 <= z <= MAX_ZOOM or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+                raise ValueError('Invalid tile %s/%s/%s' % (z, x, y))
+            return self.render_tile(path[1], z, x, y)
+        return 404, 'text/plain; charset=utf-8', b'Not found\n'
+
+    def render_generator(self, name, query):
+        processor, format = self.generators[name]
+        if format == 'geojson':
+            format = query.get('format', 'geojson')
+            if format not in GEOJSON_FORMATS:
+                raise ValueError('Unknown format %s' % format)
+        precision = get_bounded(query, 'precision', MAX_PRECISION)
+        lod = get_bounded(query, 'lod', MAX_ZOOM)
+        options = dict(self.generator_options.get(name, {}))
+        for option in ('window', 'end_year'):
+            if option in query and option in options:
+                options[option] = int(query[option])
+        if options.get('window', 1) < 1:
+            raise ValueError('window must be at least 1')
+        accidents = filter_accidents(self.accidents, query)
+        fh = io.BytesIO() if format in BINARY_FORMATS else io.StringIO()
+        OUTPUT_WRITER[format](fh, processor(self.idx, accidents, **options),
+                              precision=precision, geometries=self.idx.get_geometry_cache(lod))
+        body = fh.getvalue()
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        return 200, CONTENT_TYPES[format], body
+
+    def get_tile_layer(self, name):
+        with self.tile_layer_locks[name]:
+            if name not in self.tile_layers:
+                processor = self.generators[name][0]
+                features = processor(self.idx, self.accidents,
+                                     **self.generator_options.get(name, {}))
+                self.tile_layers[name] = TileLayer(self.idx, list(features))
+            return self.tile_layers[name]
+
+    def render_tile(self, name, z, x, y):
+        fh = io.StringIO()
+        write_geojson(fh, self.get_tile_layer(name).get_features(z, x, y))
+        return 200, CONTENT_TYPES['geojson'], fh.getvalue().encode('utf-8')
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        status, content_type, body = self.server.get_response(self.path)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(idx, accidents, generators, host='127.0.0.1', port=8000,
+          generator_options=None):
+    server = QueryServer((host, port), idx, accidents, generators,
+                         generator_options=generator_options)
+    print('Serving on http://%s:%d/' % (host, port), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,149 @@
+'''
+Prebuilt GeoIndex snapshot that is memory-mapped on load.
+
+Layout: magic, header length, JSON header (feature properties, name
+table, best candidates per district, mapping, districts), then 8-byte
+aligned arrays of WKB offsets and lengths followed by all WKB
+geometries in one contiguous buffer.
+Geometries are only parsed when they are first accessed.
+The arrays use native byte order, so snapshots are meant to be built
+on the machine that uses them.
+'''
+from array import array
+import json
+import mmap
+import struct
+
+from shapely import wkb
+from shapely.geometry import mapping
+
+
+MAGIC = b'VUSIDX01'
+HEADER_LEN = struct.Struct('<Q')
+
+
+def _pad(length):
+    return (8 - length % 8) % 8
+
+
+class LazyGeometries(object):
+    def __init__(self, buffer, offsets):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        try:
+            return self.cache[i]
+        except KeyError:
+            pass
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        geom = wkb.loads(bytes(self.buffer[self.offsets[i]:self.offsets[i + 1]]))
+        self.cache[i] = geom
+        return geom
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class LazyFeatures(object):
+    def __init__(self, properties, geometries):
+        self.properties = properties
+        self.geometries = geometries
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.properties)
+
+    def __getitem__(self, i):
+        try:
+            return self.cache[i]
+        except KeyError:
+            pass
+        feature = {
+            'type': 'Feature',
+            'properties': self.properties[i],
+            'geometry': mapping(self.geometries[i])
+        }
+        self.cache[i] = feature
+        return feature
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def write_snapshot(filename, idx):
+    shapes = list(idx.shapes)
+    district_names = list(idx.districts.keys())
+    geometries = [s.wkb for s in shapes] + [
+        idx.districts[name].wkb for name in district_names]
+
+    offsets = array('Q', [0])
+    for geom in geometries:
+        offsets.append(offsets[-1] + len(geom))
+    lengths = array('d', [float('nan') if length is None else length
+                          for length in idx.shape_lengths])
+
+    header = json.dumps({
+        'version': idx.version,
+        'backend': idx.geometry.name,
+        'count': len(shapes),
+        'properties': [f['properties'] for f in idx.features],
+        'names': idx.names,
+        'best_candidates': idx.best_candidates,
+        'mapping': idx.mapping,
+        'districts': district_names,
+        'district_history': {k: list(v.coords[0])
+                             for k, v in idx.district_history.items()},
+    }, separators=(',', ':')).encode('utf-8')
+    header += b' ' * _pad(len(MAGIC) + HEADER_LEN.size + len(header))
+
+    with open(filename, 'wb') as fh:
+        fh.write(MAGIC)
+        fh.write(HEADER_LEN.pack(len(header)))
+        fh.write(header)
+        offsets.tofile(fh)
+        lengths.tofile(fh)
+        for geom in geometries:
+            fh.write(geom)
+
+
+def read_snapshot(filename):
+    '''
+    Returns a dict with the header entries plus lazy 'shapes' and
+    'features' sequences, a 'shape_lengths' view and district shapes.
+    '''
+    with open(filename, 'rb') as fh:
+        buffer = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    if buffer[:len(MAGIC)] != MAGIC:
+        raise Exception('%s is not a GeoIndex snapshot' % filename)
+    pos = len(MAGIC)
+    header_len, = HEADER_LEN.unpack_from(buffer, pos)
+    pos += HEADER_LEN.size
+    snapshot = json.loads(buffer[pos:pos + header_len].decode('utf-8'))
+    pos += header_len
+
+    count = snapshot['count']
+    view = memoryview(buffer)
+    geometry_count = count + len(snapshot['districts'])
+    offsets = view[pos:pos + (geometry_count + 1) * 8].cast('Q')
+    pos += (geometry_count + 1) * 8
+    lengths = view[pos:pos + count * 8].cast('d')
+    pos += count * 8
+
+    geometries = LazyGeometries(view[pos:], offsets)
+    shapes = LazyGeometries(view[pos:], offsets[:count + 1])
+    snapshot['shapes'] = shapes
+    snapshot['features'] = LazyFeatures(snapshot['properties'], shapes)
+    snapshot['shape_lengths'] = lengths
+    snapshot['districts'] = {
+        name: geometries[count + i]
+        for i, name in enumerate(snapshot['districts'])
+    }
+    return snapshot
@@ -0,0 +1,90 @@
+'''
+Counters and timers for profiling a generate.py run.
+
+Instrumented code calls stats.incr() and wraps work in stats.timer();
+both do nothing unless stats.enable() was called. With tracing on,
+every timed span is also recorded as a Chrome trace event that can be
+loaded into chrome://tracing or Perfetto.
+'''
+from collections import Counter
+from contextlib import contextmanager
+import json
+import os
+import time
+
+
+class Stats(object):
+    def __init__(self):
+        self.enabled = False
+        self.tracing = False
+        self.reset()
+
+    def reset(self):
+        self.counters = Counter()
+        self.timers = {}
+        self.events = []
+
+    def enable(self, tracing=False):
+        self.enabled = True
+        self.tracing = tracing
+
+    def incr(self, name, count=1):
+        if self.enabled:
+            self.counters[name] += count
+
+    @contextmanager
+    def timer(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            calls, total = self.timers.get(name, (0, 0.0))
+            self.timers[name] = (calls + 1, total + duration)
+            if self.tracing:
+                self.events.append({
+                    'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                    'ts': start * 1e6, 'dur': duration * 1e6
+                })
+
+    def to_dict(self):
+        return {
+            'counters': dict(self.counters),
+            'timers': {k: {'calls': c, 'seconds': t} for k, (c, t) in self.timers.items()},
+            'events': list(self.events)
+        }
+
+    def merge(self, data):
+        '''
+        Adds counters, timers and events collected by another process.
+        '''
+        self.counters.update(data['counters'])
+        for name, timer in data['timers'].items():
+            calls, total = self.timers.get(name, (0, 0.0))
+            self.timers[name] = (calls + timer['calls'], total + timer['seconds'])
+        self.events.extend(data['events'])
+
+    def format_summary(self):
+        lines = ['%-40s %8s %10s %10s' % ('timer', 'calls', 'seconds', 'ms/call')]
+        for name, (calls, total) in sorted(self.timers.items(), key=lambda x: -x[1][1]):
+            lines.append('%-40s %8d %10.3f %10.3f' % (name, calls, total, total / calls * 1000))
+        lines.append('')
+        lines.append('%-40s %8s' % ('counter', 'count'))
+        for name, count in sorted(self.counters.items()):
+            lines.append('%-40s %8d' % (name, count))
+        return '\n'.join(lines)
+
+    def write_trace(self, filename):
+        data = self.to_dict()
+        with open(filename, 'w') as f:
+            json.dump({
+                'traceEvents': data.pop('events'),
+                'displayTimeUnit': 'ms',
+                'otherData': data
+            }, f)
+
+
+stats = Stats()
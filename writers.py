@@ -0,0 +1,189 @@
+'''
+Streaming output writers for generated features and rows.
+
+GeoJSON is written with compact separators and optionally rounded
+coordinates, either as one FeatureCollection, as newline-delimited
+features or as a binary stream of length-prefixed property JSON and
+WKB geometry records. Outputs go through a large write buffer and can
+be gzipped on the fly.
+
+Features may carry a geometry_id instead of a geometry; the writers
+then take the geometry of that index feature from a GeometryCache,
+which encodes every geometry only once per run.
+'''
+from contextlib import contextmanager
+import csv
+import gzip
+import io
+import json
+import struct
+import sys
+
+from shapely.geometry import mapping, shape
+
+from stats import stats
+
+WRITE_BUFFER_SIZE = 1 << 20
+WKB_MAGIC = b'VUSFEAT1'
+RECORD_LEN = struct.Struct('<I')
+
+json_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+def round_coordinates(coordinates, precision):
+    if coordinates and isinstance(coordinates[0], (list, tuple)):
+        return [round_coordinates(c, precision) for c in coordinates]
+    return [round(c, precision) for c in coordinates]
+
+
+def round_geometry(geometry, precision):
+    if precision is None or not geometry:
+        return geometry
+    return {
+        'type': geometry['type'],
+        'coordinates': round_coordinates(geometry['coordinates'], precision)
+    }
+
+
+def round_feature(feature, precision):
+    geometry = feature.get('geometry')
+    if precision is None or not geometry:
+        return feature
+    feature = dict(feature)
+    feature['geometry'] = round_geometry(geometry, precision)
+    return feature
+
+
+class GeometryCache(object):
+    '''
+    GeoJSON text and WKB of index feature geometries, encoded on first
+    use per feature and precision. With shapes (e.g. a simplified level
+    of detail) those replace the feature geometries.
+    '''
+    def __init__(self, features, shapes=None):
+        self.features = features
+        self.shapes = shapes
+        self.json = {}
+        self.wkb = {}
+
+    def get_geometry(self, feat_id, precision=None):
+        if self.shapes is not None:
+            geometry = mapping(self.shapes[feat_id])
+        else:
+            geometry = self.features[feat_id]['geometry']
+        return round_geometry(geometry, precision)
+
+    def get_json(self, feat_id, precision=None):
+        key = (feat_id, precision)
+        if key not in self.json:
+            stats.incr('geometry_cache.miss')
+            self.json[key] = json_encoder.encode(self.get_geometry(feat_id, precision))
+        else:
+            stats.incr('geometry_cache.hit')
+        return self.json[key]
+
+    def get_wkb(self, feat_id, precision=None):
+        key = (feat_id, precision)
+        if key not in self.wkb:
+            stats.incr('geometry_cache.miss')
+            self.wkb[key] = shape(self.get_geometry(feat_id, precision)).wkb
+        else:
+            stats.incr('geometry_cache.hit')
+        return self.wkb[key]
+
+
+def encode_feature(feat, precision=None, geometries=None):
+    if 'geometry_id' in feat:
+        return '{"type":"Feature","properties":%s,"geometry":%s}' % (
+            json_encoder.encode(feat['properties']),
+            geometries.get_json(feat['geometry_id'], precision))
+    return json_encoder.encode(round_feature(feat, precision))
+
+
+@contextmanager
+def open_output(path=None, binary=False, compress=None):
+    '''
+    Opens path (or stdout) for buffered writing, gzipped if compress
+    is set or the path ends with .gz.
+    '''
+    if compress is None:
+        compress = path is not None and path.endswith('.gz')
+    if path is None:
+        raw = sys.stdout.buffer
+    else:
+        raw = open(path, 'wb')
+    stream = gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) if compress else raw
+    buffered = io.BufferedWriter(stream, WRITE_BUFFER_SIZE)
+    fh = buffered
+    if not binary:
+        fh = io.TextIOWrapper(buffered, encoding='utf-8', newline='')
+    try:
+        yield fh
+    finally:
+        fh.flush()
+        if not binary:
+            fh.detach()
+        buffered.detach()
+        if compress:
+            stream.close()
+        if path is None:
+            raw.flush()
+        else:
+            raw.close()
+
+
+def write_geojson(fh, generator, precision=None, geometries=None):
+    fh.write('{"type":"FeatureCollection","features":[')
+    first = True
+    for feat in generator:
+        if first:
+            first = False
+        else:
+            fh.write(',')
+        fh.write(encode_feature(feat, precision, geometries))
+
+    fh.write(']}')
+
+
+def write_ndjson(fh, generator, precision=None, geometries=None):
+    for feat in generator:
+        fh.write(encode_feature(feat, precision, geometries))
+        fh.write('\n')
+
+
+def write_wkb(fh, generator, precision=None, geometries=None):
+    '''
+    Binary feature stream: magic, then per feature the length-prefixed
+    properties as JSON and the length-prefixed WKB geometry.
+    '''
+    fh.write(WKB_MAGIC)
+    for feat in generator:
+        properties = json_encoder.encode(feat['properties']).encode('utf-8')
+        if 'geometry_id' in feat:
+            geometry = geometries.get_wkb(feat['geometry_id'], precision)
+        else:
+            geometry = shape(round_feature(feat, precision)['geometry']).wkb
+        fh.write(RECORD_LEN.pack(len(properties)))
+        fh.write(properties)
+        fh.write(RECORD_LEN.pack(len(geometry)))
+        fh.write(geometry)
+
+
+def write_csv(fh, generator, precision=None, geometries=None):
+    writer = None
+    for x in generator:
+        if writer is None:
+            writer = csv.DictWriter(fh, list(x.keys()))
+            writer.writeheader()
+        writer.writerow(x)
+
+
+OUTPUT_WRITER = {
+    'csv': write_csv,
+    'geojson': write_geojson,
+    'ndjson': write_ndjson,
+    'wkb': write_wkb,
+}
+
+BINARY_FORMATS = {'wkb'}
+GEOJSON_FORMATS = ('geojson', 'ndjson', 'wkb')